@@ -0,0 +1,154 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from multiprocessing import get_context
+from time import perf_counter
+import numpy as np
+import scipy
+from projector import Projector
+
+
+def get_synthetic_phantom(size):
+    # Elliptic body with denser lungs and a hot lesion, scaled to a 566 mm field of view
+    z, y, x = (np.indices((size,)*3) - (size - 1)/2)/size
+    body = y**2/0.4**2 + x**2/0.28**2 < 1
+    lungs = ((np.abs(x) - 0.12)**2/0.08**2 + y**2/0.2**2 + z**2/0.3**2) < 1
+    lesion = (x - 0.05)**2 + y**2 + z**2 < 0.05**2
+    activity_map = np.where(body, 10., 0.)
+    activity_map[lungs & body] = 2.
+    activity_map[lesion] = 40.
+    attenuation_map = np.where(body, 0.0162, 0.)
+    attenuation_map[lungs & body] = 0.0035
+    return activity_map, attenuation_map, np.full(3, 566./size)
+
+
+def get_input_phantom(size):
+    from tests import load_lung_phantom
+    return load_lung_phantom()
+
+
+PHANTOMS = {
+    'synthetic': get_synthetic_phantom,
+    'input': get_input_phantom,
+}
+
+
+def measure(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        result = function()
+        times.append(perf_counter() - start)
+    return min(times), result
+
+
+def run_case(phantom, size, angle_counts, blurring_methods, repeat):
+    start = perf_counter()
+    activity_map, attenuation_map, voxel_size = PHANTOMS[phantom](size)
+    projector = Projector(activity_map, attenuation_map, voxel_size)
+    projector.rng = np.random.default_rng(0)
+    angle = 30.
+    stages = {}
+    stages['get_rotated_activity_map'], _ = measure(lambda: projector.get_rotated_activity_map(angle), repeat)
+    stages['culculate_escape_probability'], _ = measure(lambda: projector.culculate_escape_probability(angle), repeat)
+    for blurring_method in blurring_methods:
+        projector.blurring_method = blurring_method
+        stages[f'get_projection[{blurring_method}]'], _ = measure(lambda: projector.get_projection(angle), repeat)
+    projector.blurring_method = blurring_methods[0]
+    for angle_count in angle_counts:
+        projector.angles = np.linspace(0, 360, angle_count, endpoint=False)
+        projector.noise = False
+        stages[f'run[{angle_count}]'], projections = measure(projector.run, 1)
+        stages[f'add_poisson_noise[{angle_count}]'], _ = measure(lambda: projector.add_poisson_noise(projections.copy()), repeat)
+    return {
+        'phantom': phantom,
+        'size': list(activity_map.shape),
+        'blurring_method': blurring_methods[0],
+        'wall_time': perf_counter() - start,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024,
+        'stages': stages,
+    }
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    # Stage-by-stage time ratios against a previous JSON report; returns the regressions
+    cases = {(case['phantom'], tuple(case['size'])): case for case in baseline['cases'] if 'stages' in case}
+    regressions = []
+    for case in results['cases']:
+        old_case = cases.get((case['phantom'], tuple(case['size'])))
+        if 'stages' not in case or old_case is None:
+            continue
+        for stage, time in case['stages'].items():
+            old_time = old_case['stages'].get(stage)
+            if old_time:
+                ratio = time/old_time
+                print(f"{case['phantom']} {case['size'][0]} {stage}: {old_time:.3f} s -> {time:.3f} s ({ratio:.2f}x)")
+                if ratio > 1 + threshold:
+                    regressions.append((case['phantom'], case['size'], stage, ratio))
+    return regressions
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Benchmarks of the Projector hot paths')
+    parser.add_argument('--phantoms', nargs='+', default=list(PHANTOMS), choices=list(PHANTOMS))
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64, 128, 256], help='edge lengths of the synthetic phantom, up to 512')
+    parser.add_argument('--angles', type=int, nargs='+', default=[8, 32], help='angle counts for run')
+    parser.add_argument('--blurring-methods', nargs='+', default=['sum', 'fast_step'], choices=('sum', 'step', 'fast_step'))
+    parser.add_argument('--repeat', type=int, default=3, help='repetitions per stage, the best time is kept')
+    parser.add_argument('--output', default='output/benchmarks.json')
+    parser.add_argument('--compare', help='previous JSON report to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='slowdown ratio above 1 reported as a regression')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    results = {
+        'commit': get_commit(),
+        'date': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'cpu_count': os.cpu_count(),
+        'cases': [],
+    }
+    for phantom in args.phantoms:
+        # The bundled maps have a fixed size
+        sizes = args.sizes if phantom == 'synthetic' else [None]
+        for size in sizes:
+            # A fresh process per case, so that peak RSS belongs to that case alone
+            with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as executor:
+                future = executor.submit(run_case, phantom, size, args.angles, args.blurring_methods, args.repeat)
+                try:
+                    case = future.result()
+                except Exception as error:
+                    case = {'phantom': phantom, 'size': [size]*3 if size else None, 'error': repr(error)}
+            print(json.dumps(case))
+            results['cases'].append(case)
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=1)
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        for phantom, size, stage, ratio in regressions:
+            print(f'REGRESSION {phantom} {size[0]} {stage}: {ratio:.2f}x')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
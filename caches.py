@@ -0,0 +1,33 @@
+from collections import OrderedDict
+
+
+class LRUBank:
+    # Values built on first use and kept while their arrays fit in max_bytes, least recently used out first
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._values = OrderedDict()
+        self._nbytes = {}
+
+    @property
+    def nbytes(self):
+        return sum(self._nbytes.values())
+
+    def clear(self):
+        self._values.clear()
+        self._nbytes.clear()
+
+    def get_nbytes(self, value):
+        return sum(array.nbytes for array in value)
+
+    def get(self, key, build):
+        if key in self._values:
+            self._values.move_to_end(key)
+            return self._values[key]
+        value = build()
+        self._values[key] = value
+        self._nbytes[key] = self.get_nbytes(value)
+        while len(self._values) > 1 and self.nbytes > self.max_bytes:
+            old_key, _ = self._values.popitem(last=False)
+            del self._nbytes[old_key]
+        return value
@@ -0,0 +1,164 @@
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+import numpy as np
+from loaders import load_phantom
+from projector import Projector, open_output
+
+
+_worker_maps = None
+
+
+def parse_angles(value):
+    # 'start:stop:number', the same angle set as the GUI builds
+    start, stop, number = value.split(':')
+    return np.linspace(float(start), float(stop), int(number), endpoint=False)
+
+
+def get_phantom_hash(activity_map, attenuation_map):
+    phantom_hash = hashlib.sha256()
+    for array in (activity_map, attenuation_map):
+        array = np.ascontiguousarray(array)
+        phantom_hash.update(f'{array.shape}{array.dtype}'.encode())
+        phantom_hash.update(array.data)
+    return phantom_hash.hexdigest()
+
+
+def get_key(phantom_hash, configuration):
+    text = phantom_hash + json.dumps(configuration, sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def get_configurations(args):
+    for radius, resolution, angles in product(args.radius, args.resolution, args.angles):
+        configuration = {
+            'rotation_radius': radius,
+            'spatial_resolution': (resolution, args.resolution_distance),
+            'angles': angles,
+            'rotation_axis': args.rotation_axis,
+            'projection_axis': args.projection_axis,
+            'voxel_size': args.voxel_size,
+            'blurring_method': args.blurring_method,
+            'projection_engine': args.projection_engine,
+            'precision': args.precision,
+        }
+        noisy_configurations = [
+            dict(configuration, mean_counts=args.mean_counts, seed=args.seed, realization=realization)
+            for realization in range(args.realizations)
+        ]
+        yield configuration, noisy_configurations
+
+
+def get_projector(configuration):
+    projector = Projector(*_worker_maps, configuration['voxel_size'])
+    if configuration['rotation_radius'] is not None:
+        projector.rotation_radius = configuration['rotation_radius']
+    projector.set_spatial_resolution(*configuration['spatial_resolution'])
+    projector.angles = parse_angles(configuration['angles'])
+    projector.rotation_axis = configuration['rotation_axis']
+    projector.projection_axis = configuration['projection_axis']
+    projector.blurring_method = configuration['blurring_method']
+    projector.projection_engine = configuration['projection_engine']
+    projector.precision = configuration['precision']
+    projector.noise = False
+    return projector
+
+
+def write_result(path, configuration, write):
+    # Results appear under their final name only once complete, so an interrupted sweep is never cached
+    partial_path = path[:-len('.mha')] + '.partial.mha'
+    write(partial_path)
+    with open(path[:-len('.mha')] + '.json', 'w') as file:
+        json.dump(configuration, file, sort_keys=True, indent=1)
+    os.replace(partial_path, path)
+
+
+def _init_worker(activity_map, attenuation_map):
+    global _worker_maps
+    _worker_maps = (activity_map, attenuation_map)
+
+
+def run_configuration(configuration, path, noisy_configurations, noisy_paths):
+    # The noise-free views are shared by every noise realization of a configuration
+    projector = get_projector(configuration)
+    if not os.path.exists(path):
+        def write(partial_path):
+            projector.output = partial_path
+            projector.run().flush()
+        write_result(path, configuration, write)
+    shape = tuple(int(size) for size in projector.get_projections_shape())
+    offset = os.path.getsize(path) - 8*int(np.prod(shape))
+    noise_free = np.memmap(path, np.float64, 'r', offset=offset, shape=shape)
+    for noisy_configuration, noisy_path in zip(noisy_configurations, noisy_paths):
+        def write(partial_path):
+            projector.mean_counts = noisy_configuration['mean_counts']
+            projector.rng = np.random.default_rng([noisy_configuration['seed'], noisy_configuration['realization']])
+            # Counts are integers, as Projector.run returns them
+            projections = open_output(partial_path, noise_free.shape, np.int64)
+            projector.add_poisson_noise(noise_free, output=projections)
+            projections.flush()
+        write_result(noisy_path, noisy_configuration, write)
+    return [path, *noisy_paths]
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Headless SPECT projection sweeps with an on-disk result cache')
+    parser.add_argument('activity_map', help='activity map (.mhd, .mha, .npy, .npz, .h5, or .raw/.dat with --shape)')
+    parser.add_argument('--attenuation-map', help='attenuation map in the same formats, no attenuation by default')
+    parser.add_argument('--shape', type=int, nargs=3, help='array shape of .raw and .dat phantoms')
+    parser.add_argument('--dtype', default='float64', help='element type of .raw phantoms')
+    parser.add_argument('--order', default='C', choices=('C', 'F'), help='memory order of .raw and .dat phantoms')
+    parser.add_argument('--voxel-size', type=float, nargs=3, help='voxel size in mm, taken from the activity image by default')
+    parser.add_argument('--radius', type=float, nargs='+', default=[None], help='rotation radii in mm')
+    parser.add_argument('--resolution', type=float, nargs='+', default=[7.4], help='collimator FWHM in mm at --resolution-distance')
+    parser.add_argument('--resolution-distance', type=float, default=100.)
+    parser.add_argument('--angles', nargs='+', default=['0:360:60'], help='angle sets as start:stop:number')
+    parser.add_argument('--realizations', type=int, default=0, help='Poisson noise realizations per configuration, 0 for noise-free only')
+    parser.add_argument('--mean-counts', type=int, default=100_000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rotation-axis', type=int, default=0)
+    parser.add_argument('--projection-axis', type=int, default=1)
+    parser.add_argument('--blurring-method', default='sum', choices=('sum', 'step', 'fast_step'))
+    parser.add_argument('--projection-engine', default='rotate', choices=('rotate', 'ray'))
+    parser.add_argument('--precision', default='float64', choices=('float64', 'float32'))
+    parser.add_argument('--cache', default='output/cache', help='directory of cached results')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    layout = (args.shape, args.dtype, args.order)
+    activity_map, voxel_size = load_phantom(args.activity_map, *layout)
+    attenuation_map = np.zeros_like(activity_map) if args.attenuation_map is None else load_phantom(args.attenuation_map, *layout)[0]
+    if args.voxel_size is None:
+        args.voxel_size = [1., 1., 1.] if voxel_size is None else voxel_size.tolist()
+    os.makedirs(args.cache, exist_ok=True)
+    phantom_hash = get_phantom_hash(activity_map, attenuation_map)
+    get_path = lambda configuration: os.path.join(args.cache, get_key(phantom_hash, configuration) + '.mha')
+
+    tasks = []
+    cached = 0
+    for configuration, noisy_configurations in get_configurations(args):
+        path = get_path(configuration)
+        noisy_paths = [get_path(noisy_configuration) for noisy_configuration in noisy_configurations]
+        missing = [i for i, noisy_path in enumerate(noisy_paths) if not os.path.exists(noisy_path)]
+        cached += len(noisy_paths) - len(missing) + os.path.exists(path)
+        if missing or not os.path.exists(path):
+            noisy_configurations = [noisy_configurations[i] for i in missing]
+            tasks.append((configuration, path, noisy_configurations, [noisy_paths[i] for i in missing]))
+    print(f'{cached} results cached, {len(tasks)} configurations to run')
+
+    if not tasks:
+        return
+    with ProcessPoolExecutor(args.workers, initializer=_init_worker, initargs=(activity_map, attenuation_map)) as executor:
+        for paths in executor.map(run_configuration, *zip(*tasks)):
+            for path in paths:
+                print(path)
+
+
+if __name__ == '__main__':
+    main()
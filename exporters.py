@@ -0,0 +1,74 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import SimpleITK as sitk
+
+
+def get_projection_metadata(projector):
+    return {
+        'angles': [float(angle) for angle in projector.angles],
+        'rotation_radius': float(projector.rotation_radius),
+        'rotation_axis': int(projector.rotation_axis),
+        'projection_axis': int(projector.projection_axis),
+        'voxel_size': [float(size) for size in projector.voxel_size],
+        # Collimator FWHM in mm at 100 mm
+        'spatial_resolution': float(100/projector.half_tan_fi),
+        'blurring_method': projector.blurring_method,
+        'noise': bool(projector.noise),
+        'mean_counts': int(projector.mean_counts),
+    }
+
+
+def get_compact_counts(projections):
+    # Integer counts in the smallest unsigned type that holds them
+    if projections.dtype.kind not in 'iu' or projections.min() < 0:
+        return projections
+    return projections.astype(np.min_scalar_type(projections.max()), copy=False)
+
+
+def save_array(path, array):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.npy':
+        np.save(path, array)
+    elif extension in ('.mha', '.mhd', '.nrrd', '.dcm'):
+        sitk.WriteImage(sitk.GetImageFromArray(np.ascontiguousarray(array)), path)
+    elif extension in ('.raw', '.bin', '.img'):
+        np.ascontiguousarray(array).tofile(path)
+    elif extension in ('.dat', '.txt'):
+        np.savetxt(path, array if array.ndim <= 2 else array.ravel(), fmt='%d' if array.dtype.kind in 'iu' else '%.18e')
+    else:
+        raise ValueError(path)
+
+
+def save_projections(path, projections, metadata=None, compress=False):
+    # The whole stack in one file with the acquisition metadata: in the header of .mha/.mhd/.nrrd,
+    # inside .npz, and in a .json next to formats without one. compress stores integer counts
+    # in the smallest type, zlib-compressed where the format allows it.
+    metadata = {} if metadata is None else metadata
+    projections = np.asarray(projections)
+    if compress:
+        projections = get_compact_counts(projections)
+    stem, extension = os.path.splitext(path)
+    extension = extension.lower()
+    if extension in ('.mha', '.mhd', '.nrrd'):
+        image = sitk.GetImageFromArray(np.ascontiguousarray(projections))
+        for key, value in metadata.items():
+            image.SetMetaData(key, json.dumps(value))
+        sitk.WriteImage(image, path, useCompression=compress)
+    elif extension == '.npz':
+        save = np.savez_compressed if compress else np.savez
+        save(path, projections=projections, metadata=json.dumps(metadata))
+    else:
+        save_array(path, projections)
+        with open(stem + '.json', 'w') as file:
+            json.dump(metadata, file, indent=1)
+
+
+def save_views(path, projections, workers=None):
+    # One file per view, numbered from 1 after the stem of path, written by a thread pool
+    stem, extension = os.path.splitext(path)
+    paths = [f'{stem}{number}{extension}' for number in range(1, len(projections) + 1)]
+    with ThreadPoolExecutor(workers) as executor:
+        list(executor.map(save_array, paths, projections))
+    return paths
@@ -0,0 +1,64 @@
+import numpy as np
+from scipy.ndimage import correlate1d
+from caches import LRUBank
+
+
+def gaussian_kernel(sigma, truncate=4.):
+    if sigma <= 1e-15:
+        return np.ones(1)
+    radius = int(truncate*sigma + 0.5)
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5*(x/sigma)**2)
+    return kernel/kernel.sum()
+
+
+def separable_filter(array, kernels, output=None):
+    for axis, kernel in enumerate(kernels):
+        if kernel.size > 1:
+            array = correlate1d(array, kernel, axis=axis, mode='reflect')
+    if output is None:
+        return array
+    output[...] = array
+    return output
+
+
+def correlate1d_adjoint(array, kernel, axis):
+    # Transpose of correlate1d(..., mode='reflect'): spread into the padded border, then fold it back
+    radius = kernel.size//2
+    size = array.shape[axis]
+    padding = [(0, 0)]*array.ndim
+    padding[axis] = (radius, radius)
+    padded = correlate1d(np.pad(array, padding), kernel[::-1], axis=axis, mode='constant')
+    padded = np.moveaxis(padded, axis, 0)
+    result = padded[radius:radius + size].copy()
+    border = np.r_[:radius, radius + size:size + 2*radius]
+    np.add.at(result, np.pad(np.arange(size), radius, mode='symmetric')[border], padded[border])
+    return np.moveaxis(result, 0, axis)
+
+
+def separable_filter_adjoint(array, kernels):
+    for axis, kernel in reversed(list(enumerate(kernels))):
+        if kernel.size > 1:
+            array = correlate1d_adjoint(array, kernel, axis)
+    return array
+
+
+def depth_filter(volume, kernels, axis, output=None):
+    output = np.empty_like(volume) if output is None else output
+    indices = [slice(None)]*volume.ndim
+    for i, depth_kernels in enumerate(kernels):
+        indices[axis] = i
+        separable_filter(volume[tuple(indices)], depth_kernels, output[tuple(indices)])
+    return output
+
+
+class KernelBank(LRUBank):
+
+    def __init__(self, max_bytes=64*2**20):
+        super().__init__(max_bytes)
+
+    def get_nbytes(self, kernels):
+        return sum(kernel.nbytes for depth_kernels in kernels for kernel in depth_kernels)
+
+    def get(self, key, get_sigmas):
+        return super().get(key, lambda: [tuple(gaussian_kernel(sigma) for sigma in sigmas) for sigmas in get_sigmas()])
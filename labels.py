@@ -0,0 +1,40 @@
+import numpy as np
+
+
+class LabelIndex:
+    # The unique values of a label map and, per voxel, the position of its value among them;
+    # any number of value changes is then one lookup-table gather
+
+    def __init__(self, array):
+        self.values, self.counts = np.unique(array, return_counts=True)
+        dtype = np.min_scalar_type(max(self.values.size - 1, 0))
+        span = self.values[-1] - self.values[0] if self.values.size else 0
+        if self.values.size and np.all(np.mod(self.values, 1) == 0) and span < 2**20:
+            # Whole-number labels index a table directly
+            table = np.zeros(int(span) + 1, dtype=dtype)
+            table[(self.values - self.values[0]).astype(np.intp)] = np.arange(self.values.size)
+            labels = np.asarray(array).astype(np.intp)
+            labels -= int(self.values[0])
+            self.index = table[labels]
+        else:
+            # Otherwise a binary search, still cheaper than the argsort of np.unique(return_inverse=True)
+            self.index = np.searchsorted(self.values, array).astype(dtype)
+
+    def get_lookup_table(self, mapping, default=None, dtype=None):
+        # Labels missing from mapping keep their value, or take default when it is given;
+        # keys that are not labels of the map are ignored
+        dtype = self.values.dtype if dtype is None else dtype
+        table = np.array(self.values if default is None else np.full(self.values.size, default), dtype=dtype)
+        labels = np.fromiter(mapping.keys(), dtype=float, count=len(mapping))
+        positions = np.searchsorted(self.values, labels)
+        found = positions < self.values.size
+        found[found] = self.values[positions[found]] == labels[found]
+        table[positions[found]] = np.fromiter(mapping.values(), dtype=float, count=len(mapping))[found]
+        return table
+
+    def remap(self, mapping, default=None, dtype=None):
+        return self.get_lookup_table(mapping, default, dtype)[self.index]
+
+
+def remap_labels(array, mapping, default=None, dtype=None):
+    return LabelIndex(array).remap(mapping, default, dtype)
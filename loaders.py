@@ -0,0 +1,76 @@
+import os
+import numpy as np
+import SimpleITK as sitk
+
+
+_meta_types = {
+    'MET_UCHAR': np.uint8, 'MET_CHAR': np.int8, 'MET_USHORT': np.uint16, 'MET_SHORT': np.int16,
+    'MET_UINT': np.uint32, 'MET_INT': np.int32, 'MET_ULONG_LONG': np.uint64, 'MET_LONG_LONG': np.int64,
+    'MET_FLOAT': np.float32, 'MET_DOUBLE': np.float64,
+}
+RAW_EXTENSIONS = ('.raw', '.bin', '.img')
+TEXT_EXTENSIONS = ('.dat', '.txt')
+
+
+def load_meta_image(path):
+    # Uncompressed .mhd/.mha data is memory-mapped; anything else goes through SimpleITK
+    with open(path, 'rb') as file:
+        header = {}
+        for line in file:
+            key, _, value = line.decode('latin-1').partition('=')
+            header[key.strip()] = value.strip()
+            if key.strip() == 'ElementDataFile':
+                break
+        header_size = file.tell()
+    spacing = header.get('ElementSpacing', header.get('ElementSize'))
+    # Files list the spacing x first, the arrays are indexed z first
+    spacing = None if spacing is None else np.array(spacing.split(), dtype=float)[::-1]
+    data_file = header.get('ElementDataFile', '')
+    mappable = (
+        header.get('CompressedData', 'False') == 'False' and header.get('ElementType') in _meta_types
+        and int(header.get('ElementNumberOfChannels', 1)) == 1 and data_file != 'LIST' and '%' not in data_file
+    )
+    if not mappable:
+        image = sitk.ReadImage(path)
+        return sitk.GetArrayFromImage(image), np.array(image.GetSpacing()[::-1])
+    shape = tuple(int(size) for size in reversed(header['DimSize'].split()))
+    msb = header.get('BinaryDataByteOrderMSB', header.get('ElementByteOrderMSB', 'False')) == 'True'
+    dtype = np.dtype(_meta_types[header['ElementType']]).newbyteorder('>' if msb else '<')
+    if data_file == 'LOCAL':
+        data_path, offset = path, header_size
+    else:
+        data_path, offset = os.path.join(os.path.dirname(path), data_file), int(header.get('HeaderSize', 0))
+    if offset < 0:
+        # HeaderSize = -1: the data is at the end of the file
+        offset = os.path.getsize(data_path) - dtype.itemsize*int(np.prod(shape))
+    return np.memmap(data_path, dtype, 'c', offset=offset, shape=shape), spacing
+
+
+def load_phantom(path, shape=None, dtype=None, order='C'):
+    # A phantom and its voxel size in array axis order, None when the format does not store one.
+    # Binary data is memory-mapped copy-on-write, so only the pages that are used are read. Raw
+    # and text files need their shape; raw files also their dtype, float64 by default.
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.npy':
+        return np.load(path, mmap_mode='c'), None
+    if extension == '.npz':
+        with np.load(path) as archive:
+            return archive[archive.files[0]], None
+    if extension in ('.h5', '.hdf5'):
+        import h5py
+        with h5py.File(path, 'r') as file:
+            dataset = next(item for item in file.values() if isinstance(item, h5py.Dataset))
+            spacing = dataset.attrs.get('spacing')
+            return dataset[()], None if spacing is None else np.array(spacing, dtype=float)
+    if extension in ('.mhd', '.mha'):
+        return load_meta_image(path)
+    if extension in ('.dcm', '.nii'):
+        image = sitk.ReadImage(path)
+        return sitk.GetArrayFromImage(image), np.array(image.GetSpacing()[::-1])
+    if shape is None:
+        raise ValueError(f'{path}: the shape is required')
+    if extension in RAW_EXTENSIONS:
+        return np.memmap(path, np.dtype(dtype or np.float64), 'c', shape=tuple(shape), order=order), None
+    if extension in TEXT_EXTENSIONS:
+        return np.loadtxt(path).reshape(shape, order=order), None
+    raise ValueError(path)
@@ -1,30 +1,67 @@
 import sys
+from threading import Event
 from PyQt5.QtWidgets import QApplication
 from PyQt5.QtCore import QThread, pyqtSignal
 from visualisation.managers import MainParameters, Editor
 from visualisation.windowsUI import MainWindow
+from exporters import get_projection_metadata
 from projector import Projector
+from profiling import Profiler
 import numpy as np
 
 
+class ProjectionCancelled(Exception):
+    pass
+
+
 class QProjector(Projector, QThread):
     progress = pyqtSignal(int)
+    projectionReport = pyqtSignal(int, np.ndarray)
     resultReport = pyqtSignal(np.ndarray)
+    profileReport = pyqtSignal(dict)
+    cancelReport = pyqtSignal()
     
     def __init__(self, activity_map, attenuation_map=None, parent=None):
         QThread.__init__(self, parent)
         Projector.__init__(self, activity_map, attenuation_map)
-
-    def get_projection(self, angle=0):
-        result = super().get_projection(angle)
-        index = np.argwhere(self.angles == angle)
-        progress = int(100*index/(self.angles.size - 1))
-        self.progress.emit(progress)
-        return result
+        self.profiler = Profiler()
+        self._resumed = Event()
+        self._resumed.set()
+        self._cancelled = False
+    
+    def pause(self, paused=True):
+        if paused:
+            self._resumed.clear()
+        else:
+            self._resumed.set()
+    
+    def cancel(self):
+        self._cancelled = True
+        self._resumed.set()
+    
+    def iter_projections(self):
+        # Every view is reported as soon as it is done, whether computed here or by the worker pool
+        projections = super().iter_projections()
+        try:
+            for completed, (index, projection) in enumerate(projections, 1):
+                self.projectionReport.emit(index, projection)
+                self.progress.emit(int(100*completed/len(self.angles)))
+                self._resumed.wait()
+                if self._cancelled:
+                    raise ProjectionCancelled
+                yield index, projection
+        finally:
+            projections.close()
     
     def run(self):
-        result = super().run()
+        self.profiler.clear()
+        try:
+            result = super().run()
+        except ProjectionCancelled:
+            self.cancelReport.emit()
+            return
         self.resultReport.emit(result)
+        self.profileReport.emit(self.profiler.summary())
 
 
 class Main(MainWindow, MainParameters, Editor):
@@ -34,12 +71,46 @@ class Main(MainWindow, MainParameters, Editor):
         MainParameters.__init__(self)
         Editor.__init__(self)
         self.pushButtonOfRun.clicked.connect(self.startProjector)
+        self.pushButtonOfPause.toggled.connect(self.pauseProjector)
+        self.pushButtonOfCancel.clicked.connect(self.cancelProjector)
+        self.projector = None
         
     def reportProgress(self, value):
         self.progressBar.setValue(value)
+        
+    def reportProfile(self, summary):
+        # Totals per stage in the status bar, every timing in its tooltip
+        self.statusbar.showMessage(', '.join(f"{name} {stage['total']:.2f} s" for name, stage in summary.items()))
+        rows = ''.join(
+            f"<tr><td>{name}</td><td>{stage['count']}</td><td>{stage['total']:.3f}</td><td>{stage['mean']:.4f}</td><td>{stage['max']:.4f}</td></tr>"
+            for name, stage in summary.items()
+        )
+        self.statusbar.setToolTip(f'<table><tr><th>stage</th><th>count</th><th>total, s</th><th>mean, s</th><th>max, s</th></tr>{rows}</table>')
+    
+    def pauseProjector(self, paused):
+        if self.projector is not None:
+            self.projector.pause(paused)
+    
+    def cancelProjector(self):
+        if self.projector is not None:
+            self.projector.cancel()
+    
+    def reportCancel(self):
+        # The views done so far stay on display
+        self.projections = self._projections
+        self.statusbar.showMessage('Projection cancelled')
+    
+    def finishProjector(self):
+        self.projector = None
+        self.pushButtonOfRun.setEnabled(True)
+        self.pushButtonOfPause.setChecked(False)
+        self.pushButtonOfPause.setEnabled(False)
+        self.pushButtonOfCancel.setEnabled(False)
     
     def startProjector(self):
         self.pushButtonOfRun.setEnabled(False)
+        self.pushButtonOfPause.setEnabled(True)
+        self.pushButtonOfCancel.setEnabled(True)
         self.reportProgress(0)
         projector = QProjector(self.activity_map, self.attenuation_map, self)
         projector.voxel_size = self.voxel_size
@@ -51,9 +122,17 @@ class Main(MainWindow, MainParameters, Editor):
         projector.mean_counts = self.mean_counts
         projector.noise = self.noise
         projector.blurring_method = self.blurring_method
+        projector.workers = self.workers
         projector.progress.connect(self.update)
         projector.progress.connect(self.reportProgress)
+        projector.projectionReport.connect(self.updateProjection)
         projector.resultReport.connect(self.updateProjections)
+        projector.profileReport.connect(self.reportProfile)
+        projector.cancelReport.connect(self.reportCancel)
+        projector.finished.connect(self.finishProjector)
+        self.projections = np.zeros(projector.get_projections_shape())
+        self.projectionMetadata = get_projection_metadata(projector)
+        self.projector = projector
         projector.start()
     
 
@@ -0,0 +1,64 @@
+import tracemalloc
+from contextlib import contextmanager
+from time import perf_counter
+
+
+class Profiler:
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.records = []
+        self.callbacks = []
+        self._stack = []
+
+    def clear(self):
+        self.records.clear()
+
+    @contextmanager
+    def stage(self, name, angle=None):
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            current, peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                self._stack[-1]['peak'] = max(self._stack[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+            self._stack.append({'start': current, 'peak': current})
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            record = {'stage': name, 'angle': None if angle is None else float(angle), 'time': perf_counter() - start, 'allocated': None}
+            if self.trace_memory:
+                # Peak of the traced memory above its level at entry, nested stages included
+                entry = self._stack.pop()
+                peak = max(entry['peak'], tracemalloc.get_traced_memory()[1])
+                record['allocated'] = peak - entry['start']
+                if self._stack:
+                    self._stack[-1]['peak'] = max(self._stack[-1]['peak'], peak)
+            self.records.append(record)
+            for callback in self.callbacks:
+                callback(record)
+
+    def summary(self):
+        summary = {}
+        for record in self.records:
+            stage = summary.setdefault(record['stage'], {'count': 0, 'total': 0., 'max': 0., 'allocated': None})
+            stage['count'] += 1
+            stage['total'] += record['time']
+            stage['max'] = max(stage['max'], record['time'])
+            if record['allocated'] is not None:
+                stage['allocated'] = max(stage['allocated'] or 0, record['allocated'])
+        for stage in summary.values():
+            stage['mean'] = stage['total']/stage['count']
+        return summary
+
+    def per_angle(self, name):
+        return {record['angle']: record['time'] for record in self.records if record['stage'] == name}
+
+    def report(self):
+        lines = [f"{'stage':<20}{'count':>7}{'total, s':>11}{'mean, s':>11}{'max, s':>11}{'peak, MiB':>11}"]
+        for name, stage in self.summary().items():
+            allocated = '' if stage['allocated'] is None else f"{stage['allocated']/2**20:.1f}"
+            lines.append(f"{name:<20}{stage['count']:>7}{stage['total']:>11.3f}{stage['mean']:>11.4f}{stage['max']:>11.4f}{allocated:>11}")
+        return '\n'.join(lines)
@@ -1,6 +1,81 @@
+import hashlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from itertools import islice
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
 import numpy as np
 from numpy import cos, sin, arctan, tan, exp, abs, sqrt
-from scipy.ndimage import rotate, gaussian_filter
+from scipy.ndimage import gaussian_filter
+from profiling import Profiler
+from kernels import KernelBank, depth_filter, separable_filter, separable_filter_adjoint
+from rotation import RayTableBank, crop_rotation_table, get_ray_table, get_rotation_table, rotate_volume, rotate_volume_adjoint, sample_ray_slice
+
+
+_no_profile = nullcontext()
+_worker_projector = None
+_worker_memory = []
+
+
+def _init_worker(parameters, shared_arrays):
+    global _worker_projector
+    maps = []
+    for name, shape, dtype in shared_arrays:
+        memory = SharedMemory(name=name)
+        _worker_memory.append(memory)
+        maps.append(np.ndarray(shape, dtype, buffer=memory.buf))
+    _worker_projector = Projector(*maps)
+    vars(_worker_projector).update(parameters)
+    _worker_projector._reuse_rotations = True
+
+
+def _get_projections(angles):
+    return [_worker_projector.get_projection(angle) for angle in angles]
+
+
+_element_types = {np.dtype(np.float64): 'MET_DOUBLE', np.dtype(np.float32): 'MET_FLOAT', np.dtype(np.int64): 'MET_LONG_LONG', np.dtype(np.int32): 'MET_INT'}
+
+
+def open_output(path, shape, dtype=np.float64):
+    # Projections backed by a .npy or .mha file on disk
+    shape = tuple(int(size) for size in shape)
+    dtype = np.dtype(dtype)
+    if str(path).endswith('.mha'):
+        header = (
+            'ObjectType = Image\n'
+            f'NDims = {len(shape)}\n'
+            'BinaryData = True\n'
+            'BinaryDataByteOrderMSB = False\n'
+            'CompressedData = False\n'
+            f'DimSize = {" ".join(str(size) for size in reversed(shape))}\n'
+            f'ElementType = {_element_types[dtype]}\n'
+            'ElementDataFile = LOCAL\n'
+        ).encode()
+        with open(path, 'wb') as file:
+            file.write(header)
+            file.truncate(len(header) + dtype.itemsize*int(np.prod(shape)))
+        return np.memmap(path, dtype, 'r+', offset=len(header), shape=shape)
+    return np.lib.format.open_memmap(path, 'w+', dtype, shape)
+
+
+def get_array_digest(array):
+    # Fingerprint of the content of an array, for caches that must notice edits made in place
+    array = np.ascontiguousarray(array)
+    digest = hashlib.blake2b(f'{array.shape}{array.dtype}'.encode(), digest_size=16)
+    digest.update(array.data)
+    return digest.hexdigest()
+
+
+def get_bounding_region(mask):
+    # Slices of the bounding box of a boolean volume, None when it is empty
+    region = []
+    for axis in range(mask.ndim):
+        nonzero = np.flatnonzero(mask.any(axis=tuple(np.delete(np.arange(mask.ndim), axis))))
+        if not nonzero.size:
+            return None
+        region.append(slice(int(nonzero[0]), int(nonzero[-1]) + 1))
+    return tuple(region)
 
 
 class Projector:
@@ -18,7 +93,22 @@ class Projector:
         self.mean_counts: int = 100_000
         self._axes_planes = np.array([(1, 2), (0, 2), (0, 1)])
         self.blurring_method: str = 'sum'
+        self.projection_engine: str = 'rotate'
         self.rng = np.random.default_rng()
+        self.workers: int = 1
+        self.output: str = None
+        self.profiler: Profiler = None
+        self.cropping: bool = True
+        self.precision: str = 'float64'
+        self._buffers = {}
+        self._kernel_bank = KernelBank()
+        self._ray_table_bank = RayTableBank()
+        self._reuse_rotations = False
+        self._rotated_maps = None
+        self._active_region = None
+        self._maps = None
+        self._reprojection = None
+        self._basis = None
     
     @property
     def sum_counts(self):
@@ -54,17 +144,156 @@ class Projector:
         rotated_voxel_size[rotation_plane] += np.dot(rot, diff_vector)
         return abs(rotated_voxel_size)
     
-    def get_rotated_activity_map(self, angle):
+    @property
+    def dtype(self):
+        return np.dtype(self.precision)
+    
+    def get_maps(self):
+        # Activity and attenuation maps in the working precision, converted once per run. Nothing is
+        # kept between runs, so maps edited in place are picked up by the next one.
+        if self._maps is not None:
+            return self._maps
+        maps = (self.activity_map.astype(self.dtype, copy=False), self.attenuation_map.astype(self.dtype, copy=False))
+        if self._reuse_rotations:
+            self._maps = maps
+        return maps
+    
+    def clear_run_cache(self):
+        self._rotated_maps = None
+        self._maps = None
+        self._active_region = None
+    
+    def profile(self, name, angle=None):
+        return _no_profile if self.profiler is None else self.profiler.stage(name, angle)
+    
+    def get_rotation_table(self, angle):
         rotation_plane = self._axes_planes[self.rotation_axis]
-        return rotate(self.activity_map, angle, axes=rotation_plane, reshape=False, order=1)
+        plane_shape = np.array(self.activity_map.shape)[rotation_plane]
+        output_indices, indices, weights = get_rotation_table(plane_shape, angle)
+        return output_indices, indices, weights.astype(self.dtype)
+    
+    def get_rotated_activity_map(self, angle):
+        return rotate_volume(self.get_maps()[0], self.get_rotation_table(angle), self.rotation_axis)
     
     def get_rotated_attenuation_map(self, angle):
+        return rotate_volume(self.get_maps()[1], self.get_rotation_table(angle), self.rotation_axis)
+    
+    def get_rotated_maps(self, angle):
+        # Rotated maps cropped to the region of the view that can be nonzero, and that region
+        (activity_map, attenuation_map), region = self.get_rotated_volumes(angle, self.get_maps())
+        return activity_map, attenuation_map, region
+    
+    def get_rotated_volumes(self, angle, volumes, active_region=None):
+        angle = angle % 360
+        if self._reuse_rotations and self._rotated_maps is not None:
+            previous_angle, rotated_volumes, region = self._rotated_maps
+            if np.isclose((angle - previous_angle) % 360, 180):
+                # The conjugate view is the previous one turned by 180 degrees in the rotation plane
+                rotation_plane = tuple(self._axes_planes[self.rotation_axis])
+                region = list(region)
+                for axis in rotation_plane:
+                    size = self.activity_map.shape[axis]
+                    region[axis] = slice(size - region[axis].stop, size - region[axis].start)
+                return [np.flip(volume, rotation_plane) for volume in rotated_volumes], tuple(region)
+        table = self.get_rotation_table(angle)
+        region = self.get_view_region(angle, table, active_region)
+        rotated_volumes = [self.rotate_region(volume, table, region) for volume in volumes]
+        if self._reuse_rotations:
+            self._rotated_maps = (angle, rotated_volumes, region)
+        return rotated_volumes, region
+    
+    def rotate_region(self, volume, table, region):
+        # The part of the rotated volume inside a region of the rotated frame
+        rotation_plane = self._axes_planes[self.rotation_axis]
+        plane_shape = np.array(self.activity_map.shape)[rotation_plane]
+        window = [region[axis] for axis in rotation_plane]
+        table = crop_rotation_table(table, plane_shape, window)
+        window_shape = [part.stop - part.start for part in window]
+        indices = [slice(None)]*3
+        indices[self.rotation_axis] = region[self.rotation_axis]
+        return rotate_volume(volume[tuple(indices)], table, self.rotation_axis, window_shape)
+    
+    def get_active_region(self):
+        # Bounding box of nonzero activity or attenuation, None when the maps are empty; like the
+        # maps it is found once per run
+        if self._active_region is not None:
+            return self._active_region[0]
+        region = get_bounding_region((self.activity_map != 0) | (self.attenuation_map != 0))
+        if self._reuse_rotations:
+            self._active_region = (region,)
+        return region
+    
+    def get_view_region(self, angle, table, active_region=None):
+        # The rotated footprint of the active region widened by the blur margin; the view is exactly
+        # zero outside it. The margin does not depend on the footprint and is the same for an angle and its
+        # conjugate, so conjugate views get mirrored regions.
+        full_region = tuple(slice(0, size) for size in self.activity_map.shape)
+        active_region = self.get_active_region() if active_region is None else active_region
+        if not self.cropping or self.blurring_method not in ('sum', 'fast_step') or active_region is None:
+            return full_region
+        rotation_plane = self._axes_planes[self.rotation_axis]
+        plane_shape = np.array(self.activity_map.shape)[rotation_plane]
+        plane_mask = np.zeros(plane_shape, dtype=bool)
+        plane_mask[tuple(active_region[axis] for axis in rotation_plane)] = True
+        output_indices, indices, weights = table
+        footprint = np.zeros(plane_shape.prod(), dtype=bool)
+        footprint[output_indices] = np.any(plane_mask.ravel()[indices] & (weights > 0), axis=0)
+        footprint = footprint.reshape(plane_shape)
+        
+        # Kernel radii along the two axes of the projection plane, per depth. With anisotropic voxels the
+        # kernels of the conjugate view differ, so the margin covers both views of the pair.
+        margins = []
+        for view_angle in (angle, angle + 180):
+            radii = np.array([[kernel.size//2 for kernel in kernels] for kernels in self.get_kernels(view_angle)]).reshape(-1, 2)
+            margins.append(radii.max(axis=0) if self.blurring_method == 'sum' else radii.sum(axis=0))
+        margin = np.zeros(3, dtype=int)
+        margin[self._axes_planes[self.projection_axis]] = np.max(margins, axis=0)
+        
+        region = list(active_region)
+        for i, axis in enumerate(rotation_plane):
+            nonzero = np.flatnonzero(footprint.any(axis=1 - i))
+            region[axis] = slice(int(nonzero[0]), int(nonzero[-1]) + 1) if nonzero.size else slice(0, 0)
+        for axis in range(3):
+            if axis != self.projection_axis:
+                size = self.activity_map.shape[axis]
+                region[axis] = slice(max(region[axis].start - margin[axis], 0), min(region[axis].stop + margin[axis], size))
+        return tuple(region)
+    
+    def get_ray_table(self, angle):
         rotation_plane = self._axes_planes[self.rotation_axis]
-        return rotate(self.attenuation_map, angle, axes=rotation_plane, reshape=False, order=1)
+        plane_shape = tuple(np.array(self.activity_map.shape)[rotation_plane])
+        depth_axis = list(rotation_plane).index(self.projection_axis)
+        key = (plane_shape, depth_axis, round(angle % 360, 9), self.dtype)
+        get_table = lambda: get_ray_table(plane_shape, angle, depth_axis, self.dtype)
+        # Room for the tables of a whole orbit, so that the next run finds every one of them
+        table_nbytes = int(np.prod(plane_shape))*(2*4 + 2*self.dtype.itemsize + 1)
+        self._ray_table_bank.max_bytes = max(self._ray_table_bank.max_bytes, len(self.angles)*table_nbytes)
+        return self._ray_table_bank.get(key, get_table)
+    
+    def get_ray_slice(self, volume, table, depth):
+        values = sample_ray_slice(volume, table, depth, self.rotation_axis)
+        # The lateral axis of the projection plane may come before the rotation axis
+        lateral_axis = 3 - self.rotation_axis - self.projection_axis
+        return values if self.rotation_axis < lateral_axis else values.T
+    
+    def get_angle_order(self):
+        angles = np.asarray(self.angles) % 360
+        order = []
+        unused = np.ones(angles.size, dtype=bool)
+        for i in range(angles.size):
+            if not unused[i]:
+                continue
+            unused[i] = False
+            order.append(i)
+            conjugates = np.flatnonzero(unused & np.isclose((angles - angles[i]) % 360, 180))
+            if conjugates.size:
+                unused[conjugates[0]] = False
+                order.append(conjugates[0])
+        return np.array(order, dtype=int)
     
     def get_step_distance(self, angle):
         voxel_size = self.get_rotated_voxel_size(angle)
-        return voxel_size[self.projection_axis]
+        return float(voxel_size[self.projection_axis])
     
     def get_sigma_vector(self, angle):
         projection_plane = self._axes_planes[self.projection_axis]
@@ -75,6 +304,25 @@ class Projector:
         FWHM = distance/self.half_tan_fi
         return FWHM/2.36
     
+    def get_depth_sigmas(self, step_distance, detector_slice):
+        distances = step_distance*(detector_slice - np.arange(detector_slice))
+        if self.blurring_method == 'sum':
+            return self.get_sigma_at_distance(distances + self.distance_to_phantom)
+        if self.blurring_method == 'fast_step':
+            # Variance increments that leave every source with its exact total blur at the detector
+            variances = self.get_sigma_at_distance(distances + max(self.distance_to_phantom, 0.))**2
+            return sqrt(variances - np.append(variances[1:], 0.))
+        raise ValueError(self.blurring_method)
+    
+    def get_kernels(self, angle):
+        sigma_vector = self.get_sigma_vector(angle)
+        step_distance = self.get_step_distance(angle)
+        detector_slice = self.get_detector_slice(angle)
+        geometry = np.round([step_distance, self.distance_to_phantom, self.half_tan_fi, *sigma_vector], 9)
+        key = (self.blurring_method, detector_slice, *geometry)
+        get_sigmas = lambda: self.get_depth_sigmas(step_distance, detector_slice)[:, np.newaxis]/sigma_vector
+        return self._kernel_bank.get(key, get_sigmas)
+    
     def get_detector_slice(self, angle):
         axis = self.projection_axis
         step_distance = self.get_step_distance(angle)
@@ -82,50 +330,75 @@ class Projector:
         detector_slice = int(self.rotation_radius/step_distance + size/2)
         return size if detector_slice >= size else detector_slice + 1
         
-    def culculate_escape_probability(self, angle):
-        attenuation_map = self.get_rotated_attenuation_map(angle)
+    def get_buffer(self, name, shape, dtype=float):
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype=dtype)
+            self._buffers[name] = buffer
+        return buffer
+        
+    def culculate_escape_probability(self, angle, attenuation_map=None, out=None, depth_offset=0):
+        # depth_offset is the depth of the first slice of a cropped attenuation_map
+        if attenuation_map is None:
+            attenuation_map = self.get_rotated_attenuation_map(angle)
         step_distance = self.get_step_distance(angle)
-        escape_probability = np.zeros_like(attenuation_map)
+        escape_probability = self.get_buffer('escape_probability', attenuation_map.shape, attenuation_map.dtype) if out is None else out
         
         axis = self.projection_axis
-        detector_slice = self.get_detector_slice(angle)
+        detector_slice = int(np.clip(self.get_detector_slice(angle) - depth_offset, 0, attenuation_map.shape[axis]))
         
         indices = [slice(None)]*3
+        indices[axis] = slice(detector_slice, None)
+        escape_probability[tuple(indices)] = 0.
         indices[axis] = slice(detector_slice)
+        attenuation_map = attenuation_map[tuple(indices)]
+        escape_view = escape_probability[tuple(indices)]
         
         if self.blurring_method == 'sum':
-            for i in range(detector_slice):
-                indices[axis] = slice(i, detector_slice)
-                sum_attenuation = attenuation_map[tuple(indices)].sum(axis=axis)
-                indices[axis] = i
-                escape_probability[tuple(indices)] = exp(-sum_attenuation*step_distance)
-        elif self.blurring_method == 'step':
-            escape_probability[tuple(indices)] = exp(-attenuation_map[tuple(indices)]*step_distance)
+            # Path integral from every depth to the detector as a reversed cumulative sum
+            np.cumsum(np.flip(attenuation_map, axis), axis=axis, out=np.flip(escape_view, axis))
+        elif self.blurring_method in ('step', 'fast_step'):
+            escape_view[...] = attenuation_map
         else:
             raise ValueError(self.blurring_method)
+        escape_view *= -step_distance
+        np.exp(escape_view, out=escape_view)
         return escape_probability
     
     def get_projection(self, angle=0.):
-        activity_map = self.get_rotated_activity_map(angle)
-        escape_probability = self.culculate_escape_probability(angle)
+        if self.projection_engine == 'ray':
+            with self.profile('ray_projection', angle):
+                return self.get_ray_projection(angle)
+        if self.projection_engine != 'rotate':
+            raise ValueError(self.projection_engine)
+        with self.profile('rotation', angle):
+            activity_map, attenuation_map, region = self.get_rotated_maps(angle)
+        with self.profile('escape_probability', angle):
+            depth_offset = region[self.projection_axis].start
+            escape_probability = self.culculate_escape_probability(angle, attenuation_map, depth_offset=depth_offset)
         
+        with self.profile('blurring', angle):
+            return self.get_blurred_projection(angle, activity_map, escape_probability, region)
+    
+    def get_blurred_projection(self, angle, activity_map, escape_probability, region):
+        # Projection of rotated activity and escape probability cropped to a region of the rotated frame
+        axis = self.projection_axis
+        depth_offset = region[axis].start
         sigma_vector = self.get_sigma_vector(angle)
         step_distance = self.get_step_distance(angle)
         
-        axis = self.projection_axis
         detector_slice = self.get_detector_slice(angle)
+        local_detector_slice = int(np.clip(detector_slice - depth_offset, 0, activity_map.shape[axis]))
         indices = [slice(None)]*3
-        indices[axis] = slice(detector_slice)
+        indices[axis] = slice(local_detector_slice)
         
         if self.blurring_method == 'sum':
             activity_map = activity_map*escape_probability
-            for i in range(detector_slice):
-                indices[axis] = i
-                distance = step_distance*(detector_slice - i) + self.distance_to_phantom
-                sigma = self.get_sigma_at_distance(distance)
-                activity_map[tuple(indices)] = gaussian_filter(activity_map[tuple(indices)], sigma/sigma_vector)
-            projection = activity_map.sum(self.projection_axis)
-            
+            activity_view = activity_map[tuple(indices)]
+            kernels = self.get_kernels(angle)[depth_offset:depth_offset + local_detector_slice]
+            depth_filter(activity_view, kernels, axis, activity_view)
+            projection = activity_map.sum(self.projection_axis, dtype=np.float64)
+        
         elif self.blurring_method == 'step':
             projection_plane = self._axes_planes[axis]
             projection = np.zeros(np.array(activity_map.shape)[projection_plane])
@@ -146,21 +419,358 @@ class Projector:
                     sigma = sqrt((acuired_sigma**2 - current_sigma**2))
                     activity_slice = gaussian_filter(activity_slice, sigma/sigma_vector)*escape_probability[tuple(indices)]
                 projection += activity_slice
+            
+        elif self.blurring_method == 'fast_step':
+            # A single slab travels from the far side to the detector
+            projection_plane = self._axes_planes[axis]
+            projection = np.zeros(np.array(activity_map.shape)[projection_plane], dtype=activity_map.dtype)
+            kernels = self.get_kernels(angle)
+            for i in range(depth_offset, detector_slice):
+                indices[axis] = i - depth_offset
+                if indices[axis] < activity_map.shape[axis]:
+                    projection += activity_map[tuple(indices)]
+                    projection = separable_filter(projection, kernels[i])
+                    projection *= escape_probability[tuple(indices)]
+                else:
+                    # Past the cropped depths the slab is only blurred on its way to the detector
+                    projection = separable_filter(projection, kernels[i])
         else:
             raise ValueError(self.blurring_method)
+    
+        projection_plane = self._axes_planes[axis]
+        if projection.shape != tuple(np.array(self.activity_map.shape)[projection_plane]):
+            full_projection = np.zeros(np.array(self.activity_map.shape)[projection_plane])
+            full_projection[tuple(region[i] for i in projection_plane)] = projection
+            projection = full_projection
         return projection
     
-    def add_poisson_noise(self, projections):
-        projections *= self.sum_counts/projections.sum()
-        projections[...] = self.rng.poisson(projections)
+    def get_ray_projection(self, angle=0.):
+        # Samples the unrotated maps one depth slice at a time along the rotated grid
+        table = self.get_ray_table(angle)
+        step_distance = self.get_step_distance(angle)
+        detector_slice = self.get_detector_slice(angle)
+        projection_plane = self._axes_planes[self.projection_axis]
+        projection = np.zeros(np.array(self.activity_map.shape)[projection_plane], dtype=self.dtype)
+        kernels = self.get_kernels(angle)
+        activity_map, attenuation_map = self.get_maps()
         
-    def run(self):
-        projections = []
-        for angle in self.angles:
-            projection = self.get_projection(angle)
-            projections.append(projection)
-        projections = np.array(projections)
+        if self.blurring_method == 'sum':
+            path = np.zeros_like(projection)
+            for i in reversed(range(detector_slice)):
+                path += self.get_ray_slice(attenuation_map, table, i)
+                activity_slice = self.get_ray_slice(activity_map, table, i)*exp(-step_distance*path)
+                projection += separable_filter(activity_slice, kernels[i])
+                
+        elif self.blurring_method == 'fast_step':
+            for i in range(detector_slice):
+                projection += self.get_ray_slice(activity_map, table, i)
+                projection = separable_filter(projection, kernels[i])
+                projection *= exp(-step_distance*self.get_ray_slice(attenuation_map, table, i))
+        else:
+            raise ValueError(self.blurring_method)
+        return projection
+    
+    def get_system_factors(self, angle):
+        # Everything of the system model that does not depend on the activity estimate
+        rotation_table = self.get_rotation_table(angle)
+        attenuation_map = rotate_volume(self.get_maps()[1], rotation_table, self.rotation_axis)
+        escape_probability = self.culculate_escape_probability(angle, attenuation_map, np.empty_like(attenuation_map))
+        # Far end of the attenuation in the view, where the fast_step slab stops being attenuated
+        attenuation_region = get_bounding_region(self.attenuation_map != 0)
+        depth_stop = 0 if attenuation_region is None else self.get_view_region(angle, rotation_table, attenuation_region)[self.projection_axis].stop
+        return rotation_table, escape_probability, depth_stop
+    
+    def forward_project(self, activity_map, angle=0., factors=None):
+        # Projection of any activity map through the system model; only its nonzero region is processed
+        rotation_table, escape_probability, depth_stop = self.get_system_factors(angle) if factors is None else factors
+        activity_map = np.asarray(activity_map).astype(self.dtype, copy=False)
+        active_region = get_bounding_region(activity_map != 0)
+        if active_region is None:
+            projection_plane = self._axes_planes[self.projection_axis]
+            return np.zeros(np.array(activity_map.shape)[projection_plane])
+        region = self.get_view_region(angle, rotation_table, active_region)
+        if self.blurring_method == 'fast_step':
+            # The slab is still attenuated in front of the nonzero region, up to the far end of the attenuation
+            axis = self.projection_axis
+            region = list(region)
+            region[axis] = slice(region[axis].start, max(region[axis].stop, depth_stop))
+            region = tuple(region)
+        activity_map = self.rotate_region(activity_map, rotation_table, region)
+        return self.get_blurred_projection(angle, activity_map, escape_probability[region], region)
+    
+    def project_frames(self, frames):
+        # Noise-free projections of several activity maps, e.g. time frames, sharing one attenuation pass per angle
+        frames = np.asarray(frames).astype(self.dtype, copy=False)
+        projections = np.zeros((len(frames), *self.get_projections_shape()))
+        volumes = (self.get_maps()[1], *frames)
+        active_region = get_bounding_region((volumes[0] != 0) | np.any(frames != 0, axis=0))
+        if active_region is None:
+            return projections
+        self._reuse_rotations = True
+        try:
+            for index in self.get_angle_order():
+                angle = self.angles[index]
+                with self.profile('rotation', angle):
+                    (attenuation_map, *rotated_frames), region = self.get_rotated_volumes(angle, volumes, active_region)
+                with self.profile('escape_probability', angle):
+                    depth_offset = region[self.projection_axis].start
+                    escape_probability = self.culculate_escape_probability(angle, attenuation_map, depth_offset=depth_offset)
+                with self.profile('blurring', angle):
+                    for i, frame in enumerate(rotated_frames):
+                        projections[i, index] = self.get_blurred_projection(angle, frame, escape_probability, region)
+        finally:
+            self._reuse_rotations = False
+            self.clear_run_cache()
+        return projections
+    
+    def run_variants(self, attenuation_maps=None, resolutions=None):
+        # Projections for every pair of attenuation map and collimator resolution, shaped
+        # (attenuation maps, resolutions, *get_projections_shape()). A resolution is a FWHM in mm
+        # at 100 mm or a (FWHM, distance) pair. Per angle the activity map and every attenuation
+        # map are rotated once, and each escape probability is blurred for every resolution.
+        attenuation_maps = [self.attenuation_map] if attenuation_maps is None else attenuation_maps
+        half_tan_fi = self.half_tan_fi
+        if resolutions is None:
+            half_tan_fis = [half_tan_fi]
+        else:
+            half_tan_fis = [distance/value for value, distance in ((resolution, 100) if np.ndim(resolution) == 0 else resolution for resolution in resolutions)]
+        projections = np.zeros((len(attenuation_maps), len(half_tan_fis), *self.get_projections_shape()))
+        volumes = (self.get_maps()[0], *(np.asarray(attenuation_map).astype(self.dtype, copy=False) for attenuation_map in attenuation_maps))
+        active_region = get_bounding_region(np.any([volume != 0 for volume in volumes], axis=0))
+        if active_region is None:
+            return projections
+        self._reuse_rotations = True
+        try:
+            for index in self.get_angle_order():
+                angle = self.angles[index]
+                # The widest blur sets the view region shared by all resolutions
+                self.half_tan_fi = min(half_tan_fis)
+                with self.profile('rotation', angle):
+                    (activity_map, *rotated_maps), region = self.get_rotated_volumes(angle, volumes, active_region)
+                depth_offset = region[self.projection_axis].start
+                for i, attenuation_map in enumerate(rotated_maps):
+                    with self.profile('escape_probability', angle):
+                        escape_probability = self.culculate_escape_probability(angle, attenuation_map, depth_offset=depth_offset)
+                    for j, value in enumerate(half_tan_fis):
+                        self.half_tan_fi = value
+                        with self.profile('blurring', angle):
+                            projections[i, j, index] = self.get_blurred_projection(angle, activity_map, escape_probability, region)
+        finally:
+            self.half_tan_fi = half_tan_fi
+            self._reuse_rotations = False
+            self.clear_run_cache()
+        if self.noise:
+            with self.profile('noise'):
+                for variant in projections.reshape(-1, *projections.shape[2:]):
+                    self.add_poisson_noise(variant)
+            projections = projections.astype(int)
+        return projections
+    
+    def get_system_key(self):
+        # Everything the system factors depend on, for caches of projections. The attenuation map enters
+        # by content, so the caches also follow edits made in place.
+        return (
+            get_array_digest(self.attenuation_map), self.rotation_axis, self.projection_axis, tuple(self.voxel_size), self.rotation_radius,
+            self.half_tan_fi, self.blurring_method, self.dtype, tuple(self.angles),
+        )
+    
+    def get_basis_projections(self, max_bytes=256*2**20):
+        # Noise-free projections of every nonzero label of the activity map at unit activity. Labels
+        # are projected in groups that fit in max_bytes: per label its mask and the rotations of two
+        # views, the current one and the one kept for its conjugate. Every group repeats the
+        # attenuation pass, so a larger budget trades memory for time.
+        key = (get_array_digest(self.activity_map), *self.get_system_key())
+        if self._basis is None or self._basis[0] != key:
+            labels = np.unique(self.activity_map)
+            labels = labels[labels != 0]
+            basis = np.zeros((labels.size, *self.get_projections_shape()))
+            group_size = max(1, max_bytes//(3*self.dtype.itemsize*self.activity_map.size))
+            with self.profile('basis'):
+                for start in range(0, labels.size, group_size):
+                    group = labels[start:start + group_size]
+                    masks = np.empty((group.size, *self.activity_map.shape), dtype=self.dtype)
+                    for mask, label in zip(masks, group):
+                        np.equal(self.activity_map, label, out=mask)
+                    basis[start:start + group.size] = self.project_frames(masks)
+            self._basis = (key, labels, basis)
+        return self._basis[1:]
+    
+    def project_labels(self, values=None):
+        # Projections of the activity map with its labels set to new activities, {label: activity},
+        # as a weighted sum of the basis projections; labels left out keep their value
+        labels, basis = self.get_basis_projections()
+        values = {} if values is None else values
+        weights = np.array([values.get(label, label) for label in labels], dtype=float)
+        projections = np.tensordot(weights, basis, 1)
         if self.noise:
-            self.add_poisson_noise(projections)
+            with self.profile('noise'):
+                self.add_poisson_noise(projections)
             projections = projections.astype(int)
         return projections
+    
+    def reproject(self, activity_map):
+        # Noise-free projections of an edited activity map; after the first call only the edited
+        # region is projected, through system factors cached for every angle
+        activity_map = np.asarray(activity_map)
+        key = (activity_map.shape, *self.get_system_key())
+        if self._reprojection is None or self._reprojection[0] != key:
+            factors = [self.get_system_factors(angle) for angle in self.angles]
+            self._reprojection = (key, factors, np.zeros(activity_map.shape), np.zeros(self.get_projections_shape()))
+        _, factors, previous_map, projections = self._reprojection
+        delta = activity_map - previous_map
+        for i, angle in enumerate(self.angles):
+            with self.profile('reprojection', angle):
+                projections[i] += self.forward_project(delta, angle, factors[i])
+        previous_map[...] = activity_map
+        return projections.copy()
+    
+    def get_backprojection(self, projection, angle=0., factors=None):
+        # Adjoint of forward_project
+        rotation_table, escape_probability, _ = self.get_system_factors(angle) if factors is None else factors
+        kernels = self.get_kernels(angle)
+        axis = self.projection_axis
+        detector_slice = self.get_detector_slice(angle)
+        backprojection = np.zeros(escape_probability.shape, dtype=self.dtype)
+        indices = [slice(None)]*3
+        
+        if self.blurring_method == 'sum':
+            for i in range(detector_slice):
+                indices[axis] = i
+                backprojection[tuple(indices)] = separable_filter_adjoint(projection, kernels[i])
+            backprojection *= escape_probability
+        elif self.blurring_method == 'fast_step':
+            for i in reversed(range(detector_slice)):
+                indices[axis] = i
+                projection = separable_filter_adjoint(projection*escape_probability[tuple(indices)], kernels[i])
+                backprojection[tuple(indices)] = projection
+        else:
+            raise ValueError(self.blurring_method)
+        return rotate_volume_adjoint(backprojection, rotation_table, self.rotation_axis)
+    
+    def backproject(self, projections):
+        backprojection = np.zeros(self.activity_map.shape, self.dtype)
+        for angle, projection in zip(self.angles, projections):
+            backprojection += self.get_backprojection(projection, angle)
+        return backprojection
+    
+    def get_subsets(self, subsets):
+        return [np.arange(len(self.angles))[i::subsets] for i in range(subsets)]
+    
+    def reconstruct(self, projections, iterations=10, subsets=1, activity_map=None):
+        # OSEM with interleaved subsets of self.angles; subsets=1 is MLEM
+        projections = np.asarray(projections, dtype=self.dtype)
+        activity_map = np.ones(self.activity_map.shape, self.dtype) if activity_map is None else np.array(activity_map, self.dtype)
+        factors = [self.get_system_factors(angle) for angle in self.angles]
+        subsets = self.get_subsets(subsets)
+        sensitivities = []
+        for subset in subsets:
+            sensitivity = sum(self.get_backprojection(np.ones(projections.shape[1:], self.dtype), self.angles[i], factors[i]) for i in subset)
+            sensitivities.append(sensitivity)
+        for _ in range(iterations):
+            for subset, sensitivity in zip(subsets, sensitivities):
+                correction = np.zeros(activity_map.shape, self.dtype)
+                for i in subset:
+                    estimate = self.forward_project(activity_map, self.angles[i], factors[i])
+                    ratio = np.divide(projections[i], estimate, out=np.zeros_like(estimate), where=estimate > 0)
+                    correction += self.get_backprojection(ratio, self.angles[i], factors[i])
+                np.divide(activity_map*correction, sensitivity, out=activity_map, where=sensitivity > 0)
+                activity_map[sensitivity <= 0] = 0.
+        return activity_map
+    
+    def add_poisson_noise(self, projections, total=None, output=None):
+        # One view at a time, so memory-mapped projections are never loaded whole. The counts replace
+        # projections unless an output array, e.g. of integers, is given.
+        scale = self.sum_counts/(projections.sum() if total is None else total)
+        for projection, counts in zip(projections, projections if output is None else output):
+            counts[...] = self.rng.poisson(projection*scale)
+        
+    def get_noise_realizations(self, projections, realizations=1, mean_counts=None, seed=None, output=None):
+        # Poisson realizations of noise-free projections, which are left untouched, shaped
+        # (count levels, realizations, *projections.shape). Realization j of level i draws from
+        # SeedSequence(seed).spawn(levels)[i].spawn(realizations)[j], whatever the chunking.
+        levels = np.atleast_1d(self.mean_counts if mean_counts is None else mean_counts)
+        shape = (levels.size, realizations, *projections.shape)
+        noisy = np.empty(shape, dtype=int) if output is None else open_output(output, shape, int)
+        total = projections.sum()
+        chunk = max(1, 2**22//int(np.prod(projections.shape[1:])))
+        for level, level_seed, level_output in zip(levels, np.random.SeedSequence(seed).spawn(levels.size), noisy):
+            scale = level*len(projections)/total
+            for realization_seed, realization in zip(level_seed.spawn(realizations), level_output):
+                rng = np.random.default_rng(realization_seed)
+                with self.profile('noise'):
+                    for start in range(0, len(projections), chunk):
+                        realization[start:start + chunk] = rng.poisson(projections[start:start + chunk]*scale)
+        return noisy
+    
+    def get_parameters(self):
+        excluded = ('activity_map', 'attenuation_map', 'rng', 'profiler')
+        return {key: value for key, value in vars(self).items() if not key.startswith('_') and key not in excluded}
+    
+    def iter_projections_parallel(self):
+        memories = []
+        shared_arrays = []
+        try:
+            for array in (self.activity_map, self.attenuation_map):
+                array = np.ascontiguousarray(array)
+                memory = SharedMemory(create=True, size=max(array.nbytes, 1))
+                memories.append(memory)
+                np.ndarray(array.shape, array.dtype, buffer=memory.buf)[...] = array
+                shared_arrays.append((memory.name, array.shape, array.dtype))
+            initargs = (self.get_parameters(), shared_arrays)
+            order = self.get_angle_order()
+            angles = np.asarray(self.angles)
+            # Conjugate pairs stay on one worker; bigger chunks would hold back the first views and cancellation
+            chunks = iter([order[start:start + 2] for start in range(0, len(order), 2)])
+            # Spawned, not forked: the GUI starts the pool from a running QThread, and forking a
+            # multithreaded process can deadlock the child
+            with ProcessPoolExecutor(self.workers, mp_context=get_context('spawn'), initializer=_init_worker, initargs=initargs) as executor:
+                try:
+                    # At most two chunks per worker are queued, so a consumer that stops taking views,
+                    # e.g. a paused GUI, stops the workers once those are done
+                    pending = deque((chunk, executor.submit(_get_projections, angles[chunk])) for chunk in islice(chunks, 2*self.workers))
+                    while pending:
+                        chunk, future = pending.popleft()
+                        for next_chunk in islice(chunks, 1):
+                            pending.append((next_chunk, executor.submit(_get_projections, angles[next_chunk])))
+                        yield from zip(chunk, future.result())
+                finally:
+                    # A consumer that stops early does not wait for the views still queued
+                    executor.shutdown(cancel_futures=True)
+        finally:
+            for memory in memories:
+                memory.close()
+                memory.unlink()
+    
+    def iter_projections(self):
+        # Yields (index, projection) pairs in the order of get_angle_order
+        if self.workers > 1:
+            yield from self.iter_projections_parallel()
+            return
+        self._reuse_rotations = True
+        try:
+            for index in self.get_angle_order():
+                with self.profile('projection', self.angles[index]):
+                    projection = self.get_projection(self.angles[index])
+                yield index, projection
+        finally:
+            self._reuse_rotations = False
+            self.clear_run_cache()
+    
+    def get_projections_shape(self):
+        projection_plane = self._axes_planes[self.projection_axis]
+        return (len(self.angles), *np.array(self.activity_map.shape)[projection_plane])
+        
+    def run(self):
+        with self.profile('run'):
+            shape = self.get_projections_shape()
+            projections = np.empty(shape) if self.output is None else open_output(self.output, shape)
+            total = 0.
+            for index, projection in self.iter_projections():
+                projections[index] = projection
+                total += projection.sum()
+            if self.noise:
+                with self.profile('noise'):
+                    self.add_poisson_noise(projections, total)
+                if self.output is None:
+                    projections = projections.astype(int)
+        return projections
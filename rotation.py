@@ -0,0 +1,105 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.special import cosdg, sindg
+from caches import LRUBank
+
+
+def get_source_coordinates(plane_shape, angle):
+    # Coordinates in the unrotated plane of every pixel of the rotated one, and whether they fall inside it
+    plane_shape = np.asarray(plane_shape)
+    rot_matrix = np.array([[cosdg(angle), sindg(angle)], [-sindg(angle), cosdg(angle)]])
+    offset = (plane_shape - 1)/2 - rot_matrix @ ((plane_shape - 1)/2)
+    grid = np.indices(plane_shape).reshape(2, -1)
+    coordinates = rot_matrix @ grid + offset[:, np.newaxis]
+    inside = np.all((coordinates >= 0) & (coordinates <= (plane_shape - 1)[:, np.newaxis]), axis=0)
+    return coordinates, inside
+
+
+def get_rotation_table(plane_shape, angle):
+    # Bilinear gather table equivalent to scipy.ndimage.rotate(..., reshape=False, order=1)
+    plane_shape = np.asarray(plane_shape)
+    coordinates, inside = get_source_coordinates(plane_shape, angle)
+    output_indices = np.flatnonzero(inside)
+    coordinates = coordinates[:, inside]
+    floor = np.floor(coordinates).astype(np.intp)
+    fraction = coordinates - floor
+    indices = np.empty((4, output_indices.size), dtype=np.intp)
+    weights = np.empty((4, output_indices.size))
+    for k, (dy, dx) in enumerate(((0, 0), (0, 1), (1, 0), (1, 1))):
+        y = np.minimum(floor[0] + dy, plane_shape[0] - 1)
+        x = np.minimum(floor[1] + dx, plane_shape[1] - 1)
+        indices[k] = y*plane_shape[1] + x
+        weights[k] = (fraction[0] if dy else 1 - fraction[0])*(fraction[1] if dx else 1 - fraction[1])
+    return output_indices, indices, weights
+
+
+def crop_rotation_table(table, plane_shape, window):
+    # Keeps the outputs inside a window of the rotated plane, indexed within that window
+    output_indices, indices, weights = table
+    rows, columns = np.divmod(output_indices, plane_shape[1])
+    inside = (rows >= window[0].start) & (rows < window[0].stop) & (columns >= window[1].start) & (columns < window[1].stop)
+    output_indices = (rows[inside] - window[0].start)*(window[1].stop - window[1].start) + columns[inside] - window[1].start
+    return output_indices, indices[:, inside], weights[:, inside]
+
+
+def rotate_volume(volume, table, rotation_axis, plane_shape=None):
+    output_indices, indices, weights = table
+    volume = np.moveaxis(volume, rotation_axis, 0)
+    source = volume.reshape(volume.shape[0], -1)
+    plane_shape = volume.shape[1:] if plane_shape is None else tuple(plane_shape)
+    dtype = source.dtype if source.dtype.kind == 'f' else float
+    values = source[:, indices[0]]*weights[0]
+    for k in range(1, 4):
+        values += source[:, indices[k]]*weights[k]
+    rotated = np.zeros((source.shape[0], int(np.prod(plane_shape))), dtype=dtype)
+    rotated[:, output_indices] = values
+    return np.moveaxis(rotated.reshape(volume.shape[0], *plane_shape), 0, rotation_axis)
+
+
+def rotate_volume_adjoint(volume, table, rotation_axis):
+    # Transpose of rotate_volume: scatters every rotated sample back onto its four neighbours
+    output_indices, indices, weights = table
+    volume = np.moveaxis(volume, rotation_axis, 0)
+    rotated = volume.reshape(volume.shape[0], -1)
+    columns = np.broadcast_to(output_indices, indices.shape)
+    matrix = csr_matrix((weights.ravel(), (indices.ravel(), columns.ravel())), shape=(rotated.shape[1],)*2)
+    source = np.ascontiguousarray((matrix @ rotated.T).T)
+    return np.moveaxis(source.reshape(volume.shape), 0, rotation_axis)
+
+
+def get_ray_table(plane_shape, angle, depth_axis, dtype=float):
+    # Compact per-depth gather table: for every (depth, lateral) sample of the rotated plane, the row
+    # and column of its first neighbour in the unrotated plane, the two bilinear fractions and whether
+    # it falls inside the plane
+    plane_shape = np.asarray(plane_shape)
+    coordinates, inside = get_source_coordinates(plane_shape, angle)
+    # The last row or column is reached from the one before it with a fraction of 1
+    floor = np.clip(np.floor(coordinates), 0, np.maximum(plane_shape - 2, 0)[:, np.newaxis])
+    fractions = np.where(inside, coordinates - floor, 0.)
+    floor[:, ~inside] = 0
+    table = []
+    for array in (floor[0].astype(np.int32), floor[1].astype(np.int32), fractions[0].astype(dtype), fractions[1].astype(dtype), inside):
+        table.append(np.ascontiguousarray(np.moveaxis(array.reshape(plane_shape), depth_axis, 0)))
+    return tuple(table)
+
+
+def sample_ray_slice(volume, table, depth, rotation_axis):
+    # Bilinear samples of one depth slice of the rotated volume, shaped (rotation axis, lateral)
+    rows, columns, row_fractions, column_fractions, inside = (array[depth] for array in table)
+    volume = np.moveaxis(volume, rotation_axis, 0)
+    # Planes one voxel thick have no second neighbour, and their fraction is 0
+    next_rows = rows + (volume.shape[1] > 1)
+    next_columns = columns + (volume.shape[2] > 1)
+    top = volume[:, rows, columns]
+    top += (volume[:, rows, next_columns] - top)*column_fractions
+    bottom = volume[:, next_rows, columns]
+    bottom += (volume[:, next_rows, next_columns] - bottom)*column_fractions
+    top += (bottom - top)*row_fractions
+    top *= inside
+    return top
+
+
+class RayTableBank(LRUBank):
+
+    def __init__(self, max_bytes=256*2**20):
+        super().__init__(max_bytes)
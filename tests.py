@@ -1,6 +1,20 @@
+import io
+import json
+import os
+import shutil
+import tracemalloc
+from contextlib import redirect_stdout
+from time import perf_counter
 import numpy as np
+from scipy.ndimage import rotate
 from SimpleITK import ReadImage, GetArrayFromImage, GetImageFromArray, WriteImage
+import cli
+from benchmarks import get_synthetic_phantom
+from exporters import save_projections, save_views
+from labels import LabelIndex, remap_labels
+from loaders import load_phantom
 from projector import Projector
+from profiling import Profiler
 
 def siringe_test():
     activity_map = np.zeros((101, 300, 101), dtype=float)
@@ -18,31 +32,439 @@ def siringe_test():
     WriteImage(projections, f'output/siringe_test_{projector.blurring_method}.mha')
         
     
-def lung_test():
-    activity_map_image = ReadImage('input/activity_map.mhd')
-    # attenuation_map_image = ReadImage('input/attenuation_map.mhd')
-    activity_map = GetArrayFromImage(activity_map_image)
-    # attenuation_map = GetArrayFromImage(attenuation_map_image)
+def load_lung_phantom():
+    # The voxel size comes back in array axis order, as the projector reads it
+    activity_map, voxel_size = load_phantom('input/activity_map.mhd')
     print(np.unique(activity_map))
-    attenuation_map = np.ones_like(activity_map, dtype=float)*0.0162
-    attenuation_map[activity_map == 0.] = 0.
-    attenuation_map[activity_map == 10.] = 0.0035
-    attenuation_map[activity_map == 20.] = 0.0298
-    attenuation_map[activity_map == 40.] = 0.0146
+    attenuation_map = remap_labels(activity_map, {0.: 0., 10.: 0.0035, 20.: 0.0298, 40.: 0.0146}, default=0.0162, dtype=float)
     print(np.unique(attenuation_map))
+    return activity_map, attenuation_map, voxel_size
     
-    voxel_size = np.array(activity_map_image.GetSpacing())
     
+def lung_test():
+    activity_map, attenuation_map, voxel_size = load_lung_phantom()
     projector = Projector(activity_map, attenuation_map, voxel_size)
     projector.blurring_method = 'step'
     projector.noise = False
     # projector.rotation_radius = 50.
     projector.angles = np.linspace(0, 360, 30, endpoint=False)
-    projections = projector.start()
+    projections = projector.run()
     projections = np.rot90(projections, k=2, axes=(1, 2))
     projections = GetImageFromArray(projections)
     WriteImage(projections, f'output/projections_{projector.blurring_method}.mha')
 
+
+def load_lung_attenuation_map():
+    attenuation_map, voxel_size = load_phantom('input/attenuation_map.mhd')
+    return np.zeros_like(attenuation_map), attenuation_map, voxel_size
+
+
+def load_synthetic_phantom():
+    # Stands in for the lung phantom, whose raw data is not distributed with the code
+    return get_synthetic_phantom(48)
+
+
+def escape_probability_test(phantom=load_lung_attenuation_map):
+    _, attenuation_map, voxel_size = phantom()
+    projector = Projector(np.zeros_like(attenuation_map), attenuation_map, voxel_size)
+    axis = projector.projection_axis
+    for blurring_method in ('sum', 'step'):
+        projector.blurring_method = blurring_method
+        for angle in np.linspace(0, 360, 8, endpoint=False):
+            rotated_attenuation_map = projector.get_rotated_attenuation_map(angle)
+            step_distance = projector.get_step_distance(angle)
+            detector_slice = projector.get_detector_slice(angle)
+            expected = np.zeros_like(rotated_attenuation_map)
+            indices = [slice(None)]*3
+            for i in range(detector_slice):
+                indices[axis] = slice(i, detector_slice) if blurring_method == 'sum' else i
+                sum_attenuation = rotated_attenuation_map[tuple(indices)]
+                if blurring_method == 'sum':
+                    sum_attenuation = sum_attenuation.sum(axis=axis)
+                indices[axis] = i
+                expected[tuple(indices)] = np.exp(-sum_attenuation*step_distance)
+            escape_probability = projector.culculate_escape_probability(angle)
+            np.testing.assert_allclose(escape_probability, expected, rtol=1e-10, atol=1e-12)
+
+
+def fast_step_test():
+    # fast_step blurs the attenuated slab instead of every source, which is not exact. On this phantom
+    # the relative L1 error is 5.2e-3, 3.7e-3 and 3.5e-3 at the three angles, below 1e-3 at 64^3; it grows
+    # with the number of depth steps and with attenuation contrast, so the bound holds for this phantom only.
+    activity_map, attenuation_map, voxel_size = get_synthetic_phantom(128)
+    projector = Projector(activity_map, attenuation_map, voxel_size)
+    for angle in (0., 45., 90.):
+        projector.blurring_method = 'step'
+        expected = projector.get_projection(angle)
+        projector.blurring_method = 'fast_step'
+        projection = projector.get_projection(angle)
+        error = np.abs(projection - expected).sum()/expected.sum()
+        print(f'fast_step relative L1 error at {angle}: {error:.2e}')
+        assert error < 1e-2
+
+
+def parallel_test(phantom=load_lung_phantom):
+    activity_map, attenuation_map, voxel_size = phantom()
+    projector = Projector(activity_map, attenuation_map, voxel_size)
+    projector.angles = np.linspace(0, 360, 8, endpoint=False)
+    projector.rng = np.random.default_rng(0)
+    expected = projector.run()
+    projector.workers = 4
+    projector.rng = np.random.default_rng(0)
+    projections = projector.run()
+    assert np.array_equal(projections, expected)
+
+
+def rotation_test():
+    rng = np.random.default_rng(0)
+    activity_map = rng.random((20, 31, 27))
+    attenuation_map = rng.random((20, 31, 27))*0.02
+    projector = Projector(activity_map, attenuation_map)
+    projector.cropping = False
+    projector._reuse_rotations = True
+    for angle in (17., 197., 45., 90., 270.):
+        *rotated_maps, region = projector.get_rotated_maps(angle)
+        for array, rotated_map in zip((activity_map, attenuation_map), rotated_maps):
+            expected = rotate(array, angle, axes=(1, 2), reshape=False, order=1)
+            np.testing.assert_allclose(rotated_map, expected, rtol=1e-10, atol=1e-12)
+    projector.angles = np.linspace(0, 360, 8, endpoint=False)
+    assert np.array_equal(projector.get_angle_order(), [0, 4, 1, 5, 2, 6, 3, 7])
+
+
+def projection_engine_test(phantom=load_lung_phantom):
+    activity_map, attenuation_map, voxel_size = phantom()
+    projector = Projector(activity_map, attenuation_map, voxel_size)
+    angles = np.linspace(0, 360, 8, endpoint=False)
+    for blurring_method in ('sum', 'fast_step'):
+        projector.blurring_method = blurring_method
+        projections = {}
+        for projection_engine in ('rotate', 'ray'):
+            projector.projection_engine = projection_engine
+            tracemalloc.start()
+            start = perf_counter()
+            projections[projection_engine] = np.array([projector.get_projection(angle) for angle in angles])
+            elapsed = (perf_counter() - start)/angles.size
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f'{blurring_method} {projection_engine}: {elapsed:.3f} s per view, peak {peak/2**20:.0f} MiB')
+        np.testing.assert_allclose(projections['ray'], projections['rotate'], rtol=1e-10, atol=1e-12)
+    # A bank too small for the orbit grows to keep every table of a run
+    projector.angles = angles
+    projector.noise = False
+    projector._ray_table_bank.clear()
+    projector._ray_table_bank.max_bytes = 1
+    projector.run()
+    assert len(projector._ray_table_bank._values) == angles.size
+
+
+def adjoint_test():
+    rng = np.random.default_rng(0)
+    activity_map = rng.random((14, 21, 19))
+    attenuation_map = rng.random((14, 21, 19))*0.05
+    projector = Projector(activity_map, attenuation_map, [2., 3., 2.5])
+    projector.rotation_radius = 30.
+    for blurring_method in ('sum', 'fast_step'):
+        projector.blurring_method = blurring_method
+        for angle in (0., 37., 211.):
+            projection = projector.forward_project(activity_map, angle)
+            np.testing.assert_allclose(projection, projector.get_projection(angle), rtol=1e-12)
+            weights = rng.random(projection.shape)
+            backprojection = projector.get_backprojection(weights, angle)
+            np.testing.assert_allclose(np.vdot(projection, weights), np.vdot(activity_map, backprojection), rtol=1e-12)
+
+
+def reconstruction_test(phantom=load_lung_phantom):
+    activity_map, attenuation_map, voxel_size = phantom()
+    projector = Projector(activity_map, attenuation_map, voxel_size)
+    projector.angles = np.linspace(0, 360, 32, endpoint=False)
+    projector.noise = False
+    projections = projector.run()
+    errors = []
+    for iterations in (1, 3):
+        start = perf_counter()
+        estimate = projector.reconstruct(projections, iterations, subsets=4)
+        print(f'OSEM, 4 subsets, {iterations} iterations: {perf_counter() - start:.1f} s')
+        estimates = np.array([projector.forward_project(estimate, angle) for angle in projector.angles])
+        errors.append(np.abs(estimates - projections).sum()/projections.sum())
+    assert errors[1] < errors[0]
+
+
+def streaming_test():
+    rng = np.random.default_rng(0)
+    projector = Projector(rng.random((20, 31, 27)), rng.random((20, 31, 27))*0.02)
+    projector.angles = np.linspace(0, 360, 12, endpoint=False)
+    projector.rng = np.random.default_rng(0)
+    expected = projector.run()
+    for output in ('output/streaming_test.npy', 'output/streaming_test.mha'):
+        projector.output = output
+        projector.rng = np.random.default_rng(0)
+        projections = projector.run()
+        projections.flush()
+        del projections
+        projections = np.load(output) if output.endswith('.npy') else GetArrayFromImage(ReadImage(output))
+        assert np.array_equal(projections, expected)
+
+
+def profiling_test():
+    rng = np.random.default_rng(0)
+    projector = Projector(rng.random((20, 31, 27)), rng.random((20, 31, 27))*0.02)
+    projector.angles = np.linspace(0, 360, 6, endpoint=False)
+    projector.profiler = Profiler(trace_memory=True)
+    projector.run()
+    summary = projector.profiler.summary()
+    for stage in ('rotation', 'escape_probability', 'blurring', 'projection'):
+        assert summary[stage]['count'] == projector.angles.size
+    assert summary['run']['allocated'] >= summary['projection']['allocated'] > 0
+    assert set(projector.profiler.per_angle('projection')) == set(projector.angles)
+    print(projector.profiler.report())
+
+
+def cropping_test(phantom=load_lung_phantom):
+    activity_map, attenuation_map, voxel_size = phantom()
+    projector = Projector(activity_map, attenuation_map, voxel_size)
+    projector.angles = np.linspace(0, 360, 8, endpoint=False)
+    projector.noise = False
+    for blurring_method in ('sum', 'fast_step'):
+        projector.blurring_method = blurring_method
+        projector.cropping = False
+        expected = projector.run()
+        projector.cropping = True
+        projections = projector.run()
+        np.testing.assert_allclose(projections, expected, rtol=1e-10, atol=1e-12*expected.max())
+    
+    # Anisotropic voxels: the conjugate view reuses the rotation but has its own kernels
+    activity_map = np.zeros((14, 23, 19))
+    activity_map[5:9, 8:15, 7:12] = np.random.default_rng(0).random((4, 7, 5))
+    projector = Projector(activity_map, None, (2, 3, 2.5))
+    projector.rotation_axis = 2
+    projector.projection_axis = 0
+    projector.angles = np.array([0, 180])
+    projector.noise = False
+    for rotation_radius in (projector.rotation_radius, 60):
+        projector.rotation_radius = rotation_radius
+        for blurring_method in ('sum', 'fast_step'):
+            projector.blurring_method = blurring_method
+            projector.cropping = False
+            expected = projector.run()
+            projector.cropping = True
+            projections = projector.run()
+            np.testing.assert_allclose(projections, expected, rtol=1e-10, atol=1e-12*expected.max())
+    
+    # Maps edited in place between runs
+    projector.precision = 'float32'
+    projector.run()
+    activity_map[1:3, 1:3, 15:18] = 3
+    projections = projector.run()
+    edited_projector = Projector(activity_map.copy(), None, projector.voxel_size)
+    vars(edited_projector).update(projector.get_parameters())
+    expected = edited_projector.run()
+    np.testing.assert_allclose(projections, expected, rtol=1e-5, atol=1e-6*expected.max())
+
+
+def precision_test(phantom=load_lung_phantom):
+    activity_map, attenuation_map, voxel_size = phantom()
+    projector = Projector(activity_map, attenuation_map, voxel_size)
+    projector.angles = np.linspace(0, 360, 8, endpoint=False)
+    projector.noise = False
+    for projection_engine in ('rotate', 'ray'):
+        projector.projection_engine = projection_engine
+        for blurring_method in ('sum', 'fast_step'):
+            projector.blurring_method = blurring_method
+            projector.precision = 'float64'
+            expected = projector.run()
+            projector.precision = 'float32'
+            projections = projector.run()
+            error = np.abs(projections - expected)
+            print(f'{projection_engine} {blurring_method} float32: max {error.max()/expected.max():.1e}, L1 {error.sum()/expected.sum():.1e}')
+            assert error.max() < 1e-5*expected.max() and error.sum() < 1e-5*expected.sum()
+
+
+def incremental_test(phantom=load_lung_phantom):
+    activity_map, attenuation_map, voxel_size = phantom()
+    projector = Projector(activity_map, attenuation_map, voxel_size)
+    projector.angles = np.linspace(0, 360, 8, endpoint=False)
+    projector.noise = False
+    edited_map = activity_map.astype(float)
+    center = np.array(activity_map.shape)//2
+    edited_map[tuple(slice(i - 3, i + 3) for i in center)] += 5*activity_map.max()
+    for blurring_method in ('sum', 'fast_step'):
+        projector.blurring_method = blurring_method
+        expected = projector.run().astype(float)
+        assert np.allclose(projector.reproject(activity_map), expected)
+        frames = projector.project_frames([activity_map, edited_map])
+        assert np.array_equal(frames[0], expected)
+        projections = projector.reproject(edited_map)
+        assert np.allclose(projections, frames[1])
+        print(f'{blurring_method} reprojection error: {np.abs(projections - frames[1]).max()/frames[1].max():.1e}')
+    # The attenuation map edited in place
+    attenuation_map = attenuation_map.copy()
+    projector.attenuation_map = attenuation_map
+    projector.reproject(edited_map)
+    attenuation_map *= 3
+    assert np.allclose(projector.reproject(edited_map), projector.project_frames([edited_map])[0])
+
+
+def basis_test(phantom=load_lung_phantom):
+    activity_map, attenuation_map, voxel_size = phantom()
+    projector = Projector(activity_map, attenuation_map, voxel_size)
+    projector.angles = np.linspace(0, 360, 8, endpoint=False)
+    projector.noise = False
+    labels, basis = projector.get_basis_projections()
+    assert basis.shape == (labels.size, *projector.get_projections_shape())
+    assert np.allclose(projector.project_labels(), projector.run())
+    values = {label: 2*label + 1 for label in labels[::2]}
+    changed_map = activity_map.astype(float)
+    for label, value in values.items():
+        changed_map[activity_map == label] = value
+    expected = Projector(changed_map, attenuation_map, voxel_size)
+    expected.angles = projector.angles
+    expected.noise = False
+    assert np.allclose(projector.project_labels(values), expected.run())
+    # One label at a time
+    peaks = []
+    for max_bytes in (256*2**20, 1):
+        projector._basis = None
+        tracemalloc.start()
+        grouped_labels, grouped_basis = projector.get_basis_projections(max_bytes)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        assert np.array_equal(grouped_labels, labels) and np.allclose(grouped_basis, basis)
+    print(f'basis peak: {peaks[0]/2**20:.0f} MiB at once, {peaks[1]/2**20:.0f} MiB per label')
+    assert peaks[1] < peaks[0]
+    # The activity map edited in place
+    edited_map = activity_map.copy()
+    projector.activity_map = edited_map
+    projector.get_basis_projections()
+    edited_map[edited_map == labels[0]] = labels[-1]
+    assert np.array_equal(projector.get_basis_projections()[0], labels[1:])
+
+
+def noise_realizations_test(phantom=load_lung_phantom):
+    activity_map, attenuation_map, voxel_size = phantom()
+    projector = Projector(activity_map, attenuation_map, voxel_size)
+    projector.angles = np.linspace(0, 360, 8, endpoint=False)
+    projector.noise = False
+    projections = projector.run()
+    expected = projections.copy()
+    levels = [1e4, 1e5]
+    noisy = projector.get_noise_realizations(projections, 4, levels, seed=1, output='output/noise_realizations.npy')
+    assert np.array_equal(projections, expected)
+    assert noisy.shape == (2, 4, *projections.shape)
+    assert np.array_equal(projector.get_noise_realizations(projections, 2, levels, seed=1), noisy[:, :2])
+    assert not np.array_equal(noisy[0, 0], noisy[0, 1])
+    counts = noisy.sum(axis=(2, 3, 4)).mean(axis=1)
+    assert np.allclose(counts, np.array(levels)*len(projector.angles), rtol=0.01)
+
+
+def loaders_test():
+    array = np.random.default_rng(0).random((6, 7, 8))
+    image = GetImageFromArray(array)
+    image.SetSpacing((1.5, 2., 2.5))
+    WriteImage(image, 'output/phantom.v1.mha')
+    loaded, voxel_size = load_phantom('output/phantom.v1.mha')
+    assert isinstance(loaded, np.memmap) and np.array_equal(loaded, array) and np.allclose(voxel_size, (2.5, 2., 1.5))
+    WriteImage(image, 'output/phantom.v1.mha', useCompression=True)
+    loaded, voxel_size = load_phantom('output/phantom.v1.mha')
+    assert np.array_equal(loaded, array) and np.allclose(voxel_size, (2.5, 2., 1.5))
+    np.save('output/phantom.v1.npy', array)
+    loaded, voxel_size = load_phantom('output/phantom.v1.npy')
+    assert isinstance(loaded, np.memmap) and np.array_equal(loaded, array) and voxel_size is None
+    array.astype(np.float32).ravel(order='F').tofile('output/phantom.v1.raw')
+    loaded, _ = load_phantom('output/phantom.v1.raw', array.shape, 'float32', 'F')
+    assert np.array_equal(loaded, array.astype(np.float32))
+    np.savetxt('output/phantom.v1.dat', array.ravel())
+    assert np.allclose(load_phantom('output/phantom.v1.dat', array.shape)[0], array)
+
+
+def exporters_test():
+    projections = np.random.default_rng(0).poisson(20., (6, 8, 9))
+    metadata = {'angles': [60.*i for i in range(6)], 'rotation_radius': 300.}
+    save_projections('output/exported.mha', projections, metadata, compress=True)
+    image = ReadImage('output/exported.mha')
+    assert np.array_equal(GetArrayFromImage(image), projections)
+    assert json.loads(image.GetMetaData('angles')) == metadata['angles']
+    save_projections('output/exported.npz', projections, metadata)
+    with np.load('output/exported.npz') as archive:
+        assert np.array_equal(archive['projections'], projections)
+        assert json.loads(str(archive['metadata'])) == metadata
+    paths = save_views('output/exported_view.npy', projections)
+    assert all(np.array_equal(np.load(path), projection) for path, projection in zip(paths, projections))
+
+
+def labels_test():
+    activity_map = np.random.default_rng(0).choice([0., 10., 20., 40., 55.], (20, 30, 40))
+    expected = np.ones_like(activity_map)*0.0162
+    expected[activity_map == 0.] = 0.
+    expected[activity_map == 10.] = 0.0035
+    expected[activity_map == 40.] = 0.0146
+    mapping = {0.: 0., 10.: 0.0035, 40.: 0.0146, 99.: 1.}
+    assert np.array_equal(remap_labels(activity_map, mapping, default=0.0162), expected)
+    label_index = LabelIndex(activity_map + 0.5)
+    assert np.array_equal(label_index.remap({20.5: 7.}), np.where(activity_map == 20., 7., activity_map + 0.5))
+    assert label_index.counts.sum() == activity_map.size
+
+
+def variants_test(phantom=load_lung_phantom):
+    activity_map, attenuation_map, voxel_size = phantom()
+    attenuation_maps = [attenuation_map, 0.8*attenuation_map]
+    resolutions = [5., (12., 150.)]
+    projector = Projector(activity_map, attenuation_map, voxel_size)
+    projector.angles = np.linspace(0, 360, 8, endpoint=False)
+    projector.noise = False
+    for blurring_method in ('sum', 'fast_step'):
+        projector.blurring_method = blurring_method
+        projections = projector.run_variants(attenuation_maps, resolutions)
+        assert projections.shape == (2, 2, *projector.get_projections_shape())
+        for i, variant_map in enumerate(attenuation_maps):
+            for j, resolution in enumerate(resolutions):
+                expected = Projector(activity_map, variant_map, voxel_size)
+                expected.angles = projector.angles
+                expected.noise = False
+                expected.blurring_method = blurring_method
+                expected.set_spatial_resolution(*np.atleast_1d(resolution))
+                assert np.allclose(projections[i, j], expected.run())
+
+
+def cli_test():
+    np.save('output/cli_test.npy', np.random.default_rng(0).random((10, 12, 11)))
+    cache = 'output/cli_test_cache'
+    shutil.rmtree(cache, ignore_errors=True)
+    argv = ['output/cli_test.npy', '--radius', '60', '80', '--angles', '0:360:4', '--realizations', '2', '--cache', cache, '--workers', '1']
+    for expected in ('0 results cached, 2 configurations to run', '6 results cached, 0 configurations to run'):
+        with redirect_stdout(io.StringIO()) as output:
+            cli.main(argv)
+        assert output.getvalue().splitlines()[0] == expected
+    paths = [os.path.join(cache, name) for name in os.listdir(cache) if name.endswith('.mha')]
+    assert len(paths) == 6
+    for path in paths:
+        projections = GetArrayFromImage(ReadImage(path))
+        with open(path[:-len('.mha')] + '.json') as file:
+            configuration = json.load(file)
+        assert projections.shape == (4, 10, 11)
+        assert projections.dtype.kind == ('i' if 'realization' in configuration else 'f')
+
+
 if __name__ == '__main__':
+    os.makedirs('output', exist_ok=True)
     siringe_test()
-    # lung_test()
\ No newline at end of file
+    fast_step_test()
+    rotation_test()
+    adjoint_test()
+    streaming_test()
+    profiling_test()
+    loaders_test()
+    exporters_test()
+    labels_test()
+    cli_test()
+    phantom_tests = (
+        escape_probability_test, parallel_test, projection_engine_test, reconstruction_test, cropping_test, precision_test,
+        incremental_test, basis_test, noise_realizations_test, variants_test,
+    )
+    if all(os.path.exists(f'input/{name}.raw') for name in ('activity_map', 'attenuation_map')):
+        for test in phantom_tests:
+            test()
+    else:
+        print('input/*.raw not found, skipping the checks on the lung phantom')
+    for test in phantom_tests:
+        test(load_synthetic_phantom)
+    # lung_test()
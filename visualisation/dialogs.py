@@ -1,4 +1,4 @@
-import numpy as np
+from labels import LabelIndex
 from visualisation.windowsUI import ChangeValueDialogBase, ShapeInputDialogBase
 from PyQt5.QtWidgets import QTableWidgetItem
 
@@ -14,15 +14,18 @@ class ShapeInputDialog(ShapeInputDialogBase):
         z = dialog.spinBoxOfShapeZ.value()
         shape = (x, y, z)
         order = dialog.comboBoxOfOrder.currentText()
-        return shape, order
+        dtype = dialog.comboBoxOfDtype.currentText()
+        return shape, order, dtype
 
 
 class ChangeValueDialog(ChangeValueDialogBase):
     
     @staticmethod
     def getChangedArray(array):
-        changedArray = array.copy()
-        unique, counts = np.unique(array, return_counts=True)
+        # Edits only collect the new values; the array is remapped once, on accept
+        labelIndex = LabelIndex(array)
+        unique, counts = labelIndex.values, labelIndex.counts
+        mapping = {}
         dialog = ChangeValueDialog()
         dialog.tableWidgetOfUniqueValues.setRowCount(unique.size)
         dialog.tableWidgetOfUniqueValues.setColumnCount(2)
@@ -33,11 +36,9 @@ class ChangeValueDialog(ChangeValueDialogBase):
         
         def itemChanged(item):
             if not item.column():
-                newValue = float(item.text())
-                index = item.row()
-                changedArray[array == unique[index]] = newValue
+                mapping[unique[item.row()]] = float(item.text())
         
         dialog.tableWidgetOfUniqueValues.itemChanged.connect(itemChanged)
         if dialog.exec():
-            return changedArray
+            return labelIndex.remap(mapping)
 
@@ -1,8 +1,13 @@
+import os
+from time import perf_counter
 import numpy as np
 import pyvista as pv
 import SimpleITK as sitk
 import pyqtgraph as pg
+from PyQt5.QtCore import QThread, pyqtSignal
 from PyQt5.QtWidgets import QFileDialog
+from exporters import save_projections, save_views
+from loaders import RAW_EXTENSIONS, TEXT_EXTENSIONS, load_phantom
 from visualisation.dialogs import ShapeInputDialog, ChangeValueDialog
 
 pg.setConfigOptions(imageAxisOrder='row-major')
@@ -21,6 +26,56 @@ sargs = dict(
 )
 
 _axes_planes = np.array([(1, 2), (0, 2), (0, 1)])
+# Largest edge, in voxels, of the first rendered level and of the finest one
+_preview_size = 64
+_render_size = 256
+
+
+def get_render_factors(shape):
+    # Downsampling factors, powers of two, from the preview to the finest rendered level
+    factors = [1]
+    while -(-max(shape)//factors[0]) > _render_size:
+        factors[0] *= 2
+    while -(-max(shape)//factors[-1]) > _preview_size:
+        factors.append(factors[-1]*2)
+    return factors[::-1]
+
+
+def halve(volume):
+    # Maximum over 2x2x2 blocks, so that small hot spots survive; odd edges keep their last slice
+    for axis in range(volume.ndim):
+        index = [slice(None)]*volume.ndim
+        index[axis] = slice(1, None, 2)
+        odd = volume[tuple(index)]
+        index[axis] = slice(0, None, 2)
+        volume = volume[tuple(index)].copy()
+        index[axis] = slice(0, odd.shape[axis])
+        np.maximum(volume[tuple(index)], odd, out=volume[tuple(index)])
+    return volume
+
+
+class PyramidBuilder(QThread):
+    levelReady = pyqtSignal(str, int, np.ndarray)
+    
+    def __init__(self, name, volume, factors, parent=None):
+        super().__init__(parent)
+        self.name = name
+        self.volume = volume
+        self.factors = factors
+    
+    def run(self):
+        # Halving is cheapest from fine to coarse, the levels are reported from coarse to fine
+        levels = {1: self.volume}
+        factor = 1
+        while factor < max(self.factors):
+            if self.isInterruptionRequested():
+                return
+            levels[2*factor] = halve(levels[factor])
+            factor *= 2
+        for factor in self.factors:
+            if self.isInterruptionRequested():
+                return
+            self.levelReady.emit(self.name, factor, np.ascontiguousarray(levels[factor]))
 
 
 class MainParameters:
@@ -32,6 +87,8 @@ class MainParameters:
         
         self._activity_map_actor = None
         self._attenuation_map_actor = None
+        self._pyramids = {}
+        self._pyramidBuilders = {}
     
     @property
     def activity_map(self):
@@ -40,13 +97,7 @@ class MainParameters:
     @activity_map.setter
     def activity_map(self, value):
         self._activity_map = value
-        if self._activity_map_actor is None:
-            self._activity_map_actor = self.openGLWidgetOfActivityMap.add_volume(value, cmap='jet', opacity='linear', scalar_bar_args=sargs)
-            self.openGLWidgetOfActivityMap.add_bounding_box()
-            self.openGLWidgetOfActivityMap.add_axes(box=True)
-        else:
-            self.openGLWidgetOfActivityMap.remove_actor(self._activity_map_actor)
-            self._activity_map_actor = self.openGLWidgetOfActivityMap.add_volume(value, cmap='jet', opacity='linear', scalar_bar_args=sargs)
+        self.renderVolume('activity_map', value)
             
     @property
     def attenuation_map(self):
@@ -55,13 +106,48 @@ class MainParameters:
     @attenuation_map.setter
     def attenuation_map(self, value):
         self._attenuation_map = value
-        if self._attenuation_map_actor is None:
-            self._attenuation_map_actor = self.openGLWidgetOfAttenuationMap.add_volume(value, cmap='bone', opacity='linear', scalar_bar_args=sargs)
-            self.openGLWidgetOfAttenuationMap.add_bounding_box()
-            self.openGLWidgetOfAttenuationMap.add_axes(box=True)
+        self.renderVolume('attenuation_map', value)
+    
+    def renderVolume(self, name, volume):
+        # A strided preview is drawn at once; finer levels, built in the background, replace it.
+        # Levels are kept per map until a new array is set.
+        builder = self._pyramidBuilders.pop(name, None)
+        if builder is not None:
+            builder.requestInterruption()
+        factors = get_render_factors(volume.shape)
+        key, levels = self._pyramids.get(name, (None, {}))
+        if key != id(volume):
+            levels = {}
+            self._pyramids[name] = (id(volume), levels)
+        if factors[-1] in levels:
+            self.showVolumeLevel(name, factors[-1], levels[factors[-1]])
+            return
+        self.showVolumeLevel(name, factors[0], volume[::factors[0], ::factors[0], ::factors[0]])
+        if len(factors) > 1:
+            builder = PyramidBuilder(name, volume, factors[1:], self)
+            builder.levelReady.connect(self.updateVolumeLevel)
+            self._pyramidBuilders[name] = builder
+            builder.start()
+    
+    def updateVolumeLevel(self, name, factor, level):
+        if self._pyramidBuilders.get(name) is self.sender():
+            self._pyramids[name][1][factor] = level
+            self.showVolumeLevel(name, factor, level)
+    
+    def showVolumeLevel(self, name, factor, level):
+        widget, cmap = {
+            'activity_map': (self.openGLWidgetOfActivityMap, 'jet'),
+            'attenuation_map': (self.openGLWidgetOfAttenuationMap, 'bone'),
+        }[name]
+        grid = pv.wrap(np.ascontiguousarray(level))
+        grid.spacing = (factor, factor, factor)
+        actor = getattr(self, f'_{name}_actor')
+        if actor is None:
+            widget.add_bounding_box()
+            widget.add_axes(box=True)
         else:
-            self.openGLWidgetOfAttenuationMap.remove_actor(self._attenuation_map_actor)
-            self._attenuation_map_actor = self.openGLWidgetOfAttenuationMap.add_volume(value, cmap='bone', opacity='linear', scalar_bar_args=sargs)
+            widget.remove_actor(actor)
+        setattr(self, f'_{name}_actor', widget.add_volume(grid, cmap=cmap, opacity='linear', scalar_bar_args=sargs))
     
     @property
     def projections(self):
@@ -123,6 +209,10 @@ class MainParameters:
     def blurring_method(self):
         return self.comboBoxOfBlurringMethod.currentText()
     
+    @property
+    def workers(self):
+        return self.spinBoxOfWorkers.value()
+    
       
 class Editor:
     
@@ -133,24 +223,25 @@ class Editor:
         self.actionSaveActivityMap.triggered.connect(self.saveActivityMap)
         self.actionSaveAttenuationMap.triggered.connect(self.saveAttenuationMap)
         self.actionSaveProjections.triggered.connect(self.saveProjections)
+        self.actionSaveProjectionViews.triggered.connect(self.saveProjectionViews)
         
         self.actionChangeActivityMap.triggered.connect(self.changeActivityMap)
         self.actionChangeAttenuationMap.triggered.connect(self.changeAttenuationMap)
         
         self.loadDirectory = 'input'
         self.saveDirectory = ''
+        self._lastDrawTime = 0.
+        self.projectionMetadata = {}
         
     def loadFile(self, fileName):
-        _, fileType = fileName.split('.')
-        if fileType == 'npy':
-            return np.load(fileName)
-        if fileType in ('dcm', 'mhd', 'mha'):
-            image = sitk.ReadImage(fileName)
-            return sitk.GetArrayFromImage(image)
-        if fileType == 'dat':
-            shape, order = ShapeInputDialog.getShape()
-            return np.loadtxt(fileName).reshape(shape, order=order)
-        raise ValueError('Неверное расширение файла')
+        # Binary formats are memory-mapped; a voxel size stored in the file replaces the one in the form
+        shape, order, dtype = None, 'C', None
+        if os.path.splitext(fileName)[1].lower() in RAW_EXTENSIONS + TEXT_EXTENSIONS:
+            shape, order, dtype = ShapeInputDialog.getShape()
+        fileArray, voxel_size = load_phantom(fileName, shape, dtype, order)
+        if voxel_size is not None:
+            self.voxel_size = voxel_size
+        return fileArray
     
     def saveFile(self, fileArray, fileName: str, **kwargs):
         _, fileType = fileName.split('.')
@@ -159,7 +250,7 @@ class Editor:
             return
         if fileType in ('dcm', 'mhd', 'mha'):
             image = sitk.GetImageFromArray(fileArray)
-            image.SetSpacing(self.voxel_size)
+            image.SetSpacing(self.voxel_size[::-1].tolist())
             sitk.WriteImage(image, fileName)
             return
         if fileType == 'dat':
@@ -189,10 +280,21 @@ class Editor:
         
     def saveProjections(self):
         fileName, _ = QFileDialog.getSaveFileName(directory=self.saveDirectory)
-        self.saveFile(self.projections, fileName)
-        path_, format_ = fileName.split(".")
-        for num, projection in enumerate(self.projections):
-            self.saveFile(projection, (path_ + f"{num + 1}." + format_))
+        if fileName:
+            save_projections(fileName, self.projections, self.projectionMetadata, self.actionCompressProjections.isChecked())
+    
+    def saveProjectionViews(self):
+        fileName, _ = QFileDialog.getSaveFileName(directory=self.saveDirectory)
+        if fileName:
+            save_views(fileName, self.projections)
+        
+    def updateProjection(self, index, projection):
+        # Views stream into the stack as they arrive; it is redrawn at most five times a second
+        self._projections[index] = projection
+        if perf_counter() - self._lastDrawTime > 0.2:
+            self._lastDrawTime = perf_counter()
+            self.openGLWidgetOfProjections.setImage(np.rot90(self._projections, k=1, axes=(1, 2)), autoRange=False)
+            self.openGLWidgetOfProjections.setCurrentIndex(index)
         
     def updateProjections(self, value):
         self.projections = value